@@ -11,6 +11,10 @@ from statsmodels.tsa.arima_model import ARMA
 import warnings
 from os import listdir
 
+from tick_store import SESSIONS
+from tick_store import seconds_from_open
+from tick_store import session_map
+
 
 def cov(a,b):
 
@@ -85,7 +89,9 @@ class VWAP(object):
         self.files = set([ filename for filename in listdir(self.DATA_PATH) if filename.endswith( '.csv' ) ])
         self.interval = interval
         self.INTERVAL = timedelta(seconds = self.interval)
-        self.nINTERVAL = 2 * int(self.HALFTIME / self.INTERVAL)
+        # the interval of each sec of the day, see tick_store.session_map
+        self._sec_iter = session_map(self.interval, SESSIONS)[1]
+        self.nINTERVAL = self._sec_iter[-1] + 1
         self.pre_days = 0
         self.features_to_train = np.ones((11,3),dtype=float) # CA, M, L, A
         self.intraday_percentage = [1 / self.nINTERVAL] * self.nINTERVAL  # notice .sum() =self.nINTERVAL
@@ -150,11 +156,7 @@ class VWAP(object):
             
             try:
                 dat.columns = ['DateTime','Volume'] # there will be Microsecond
-                dat.DateTime = [datetime.strptime(str(history_date.strftime('%Y-%m-%d')) + ' ' + dt, "%Y-%m-%d %H:%M:%S") for dt in dat.DateTime]
-                
-                # datetime to time difference
-                self.H_START_TIME = history_date.replace(hour = 9, minute = 30, second = 0, microsecond = 0)            
-                dat['TimeStamp'] = [(dt - self.H_START_TIME).total_seconds() for dt in dat.DateTime]
+                dat['TimeStamp'] = seconds_from_open(dat.DateTime)
                 dat = dat.as_matrix(columns = ['TimeStamp','Volume'])
                 
                 datCA = dat[dat[:,0] < 0]
@@ -219,10 +221,7 @@ class VWAP(object):
             try:
                 dat = pd.read_csv(self.DATA_PATH+filename)
                 dat.columns = ['DateTime','Volume']
-                self.H_START_TIME = history_date.replace(hour = 9, minute = 30, second = 0, microsecond = 0)
-                dat.DateTime = [datetime.strptime(str(history_date.strftime('%Y-%m-%d')) + ' ' + dt, 
-                                                        "%Y-%m-%d %H:%M:%S") for dt in dat.DateTime]
-                volume_sums[15 - iter] = dat[dat.DateTime > self.H_START_TIME].Volume.sum()
+                volume_sums[15 - iter] = dat[seconds_from_open(dat.DateTime) > 0].Volume.sum()
             except Exception:
                 print('Error when read file '+ filename + ', you may check its format')
                 continue
@@ -265,11 +264,7 @@ class VWAP(object):
         elif date_time < self.T_END_TIME: 
             if not self.is_V_predicted:
                 self.pred_V()
-            iter = int((date_time - self.T_START_TIME) / self.INTERVAL)
-            # if iter >= int(self.nINTERVAL * 11 / 8):
-            #     iter = int(self.nINTERVAL * 11 / 8) - 1
-            if iter > (self.nINTERVAL / 2):
-                iter -= int(self.nINTERVAL * 3 / 8)
+            iter = self._sec_iter[int((date_time - self.T_START_TIME).total_seconds())] % self.nINTERVAL # lunch ticks go to the morning's last interval
             self.today_vol[iter] += volume
             self.iter = iter
             if self.iter == self.last_update:
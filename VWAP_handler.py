@@ -11,10 +11,12 @@ import scipy.interpolate
 from sklearn.linear_model import Lasso
 from statsmodels.tsa.arima_model import ARMA
 
-from math import ceil
 import warnings
 from os import listdir
 
+from tick_store import day_sessions
+from tick_store import session_map
+
 def cov(a,b):
 
     a_mean = np.mean(a)
@@ -112,7 +114,7 @@ class VWAP(object):
         self.T_START_NANO_SEC = time.mktime(datetime.combine(self.TODAY, dt_time(hour = 9, minute = 30, second = 0, microsecond = 0) ).timetuple())
         # self.T_START_TIME = self.TODAY.replace(hour = 9, minute = 30, second = 0, microsecond = 0)
         self.T_END_TIME = kwargs['T_END_TIME']
-        self.T_END_SECS = total.seconds(self.T_END_TIME - self.T_START_TIME)
+        self.T_END_SECS = int((datetime.combine(self.TODAY,self.T_END_TIME) - datetime.combine(self.TODAY, self.T_START_TIME)).total_seconds())
         # self.T_END_TIME = self.TODAY.replace(hour = 15, minute = 00, second = 0, microsecond = 0)
         self.LASSO_LAMBDA = kwargs['LASSO_LAMBDA']
         self.N_TICK_THRESHOLD = kwargs['N_TICK_THRESHOLD'] # Tracey to notice
@@ -120,9 +122,9 @@ class VWAP(object):
         # self.DATA_PATH = './data_path/' # Tracey to notice
         self._interval = interval
         self._interval_timedelta = timedelta(seconds = self._interval)
-        self._am_n_interval = int(self.HALFTIME / self._interval_timedelta)
-        self._n_interval = self._am_n_interval + ceil((self.T_END_TIME - dt_time(hour = 13, 
-                                minute = 0, second = 0, microsecond = 0)) / interval) 
+        # the interval of each sec of the day, see tick_store.session_map
+        self._sec_iter = session_map(self._interval, day_sessions(self.T_END_SECS))[1]
+        self._n_interval = self._sec_iter[-1] + 1
         self._features_to_train = np.ones((11,3),dtype=float) # CA, M, L, A
         self._histo_volume = np.full((10, self._n_interval),0, dtype=float)  # historical trading volume        
         self._intraday_percentage = [1 / self._n_interval] * self._n_interval  # notice .sum() =self._n_interval
@@ -306,10 +308,7 @@ class VWAP(object):
             if not self.is_V_predicted:
                 self.pred_V()
             
-            iter = int(sec_time / self._interval)
-            
-            if iter > self._semi_n_interval: # in the afternoon
-                iter -= int(self._n_interval * 3 / 8)
+            iter = self._sec_iter[int(sec_time)] % self._n_interval # lunch ticks go to the morning's last interval
             
             self._today_vol[iter] += volume
             self._iter = iter
@@ -11,10 +11,13 @@ import scipy.interpolate
 from sklearn.linear_model import Lasso
 from statsmodels.tsa.arima_model import ARMA
 
-from math import ceil
 import warnings
 from os import listdir 
 
+from tick_store import day_sessions
+from tick_store import read_ticks
+from tick_store import session_map
+
 def cov(a,b):
 
     a_mean = np.mean(a)
@@ -72,7 +75,7 @@ class VWAP_handler(object):
     a single VWAP object will track and predict one ticker
     """
 
-    def __init__(self, interval, tickers, data_path ,lasso_lambda = 812314, n_tick_threshold = 1000, market_close_time = '15:00:00'):
+    def __init__(self, interval, tickers, data_path ,lasso_lambda = 812314, n_tick_threshold = 1000, market_close_time = '15:00:00', store_path = None):
 
         self.tickers = {}
         self._params = {
@@ -82,7 +85,8 @@ class VWAP_handler(object):
             'T_END_TIME': datetime.strptime(market_close_time, '%H:%M:%S').time(),
             'LASSO_LAMBDA': lasso_lambda,
             'N_TICK_THRESHOLD': n_tick_threshold, # Tracey to notice
-            'DATA_PATH': data_path  
+            'DATA_PATH': data_path,
+            'STORE_PATH': store_path
         }
 
         for ticker in tickers:
@@ -117,11 +121,13 @@ class VWAP(object):
         self.LASSO_LAMBDA = kwargs['LASSO_LAMBDA']
         self.N_TICK_THRESHOLD = kwargs['N_TICK_THRESHOLD'] # Tracey to notice
         self.DATA_PATH = kwargs['DATA_PATH']
+        self.STORE_PATH = kwargs.get('STORE_PATH') # binary tick store, csv files are the fallback
         # self.DATA_PATH = './data_path/' # Tracey to notice
         self._interval = interval
         self._interval_timedelta = timedelta(seconds = self._interval)
-        self._am_n_interval = int(self.HALFTIME.total_seconds() / self._interval_timedelta.total_seconds())
-        self._n_interval = int(self._am_n_interval + ceil(( ( self.T_END_SECS - 60 * 60 * 3.5) / self._interval)))
+        # the interval of each sec of the day, see tick_store.session_map
+        self._sec_iter = session_map(self._interval, day_sessions(self.T_END_SECS))[1]
+        self._n_interval = self._sec_iter[-1] + 1
         self._features_to_train = np.ones((11,3),dtype=float) # CA, M, L, A
         self._histo_volume = np.full((10, self._n_interval),0, dtype=float)  # historical trading volume        
         self._intraday_percentage = [1 / self._n_interval] * self._n_interval  # notice .sum() =self._n_interval
@@ -168,7 +174,7 @@ class VWAP(object):
             dates.remove(histo_date_str)
 
             try:
-                dat = pd.read_csv(self.DATA_PATH + histo_date_str + '/' + tickercsv, header = 0)
+                dat = read_ticks(self.DATA_PATH, histo_date_str, ticker, self.STORE_PATH)
             except Exception:
                 print 'Error in reading %s for %s, go to the previous day.' % (tickercsv, str(histo_date))
                 continue
@@ -230,7 +236,7 @@ class VWAP(object):
             dates.remove(histo_date_str)
 
             try:
-                dat = pd.read_csv(self.DATA_PATH + histo_date_str + '/' + tickercsv, header = 0)
+                dat = read_ticks(self.DATA_PATH, histo_date_str, ticker, self.STORE_PATH)
             except Exception:
                 print 'Error in reading %s for %s, go to the previous day.' % (tickercsv, str(histo_date)) 
                 continue     
@@ -313,10 +319,7 @@ class VWAP(object):
             if not self._is_V_predicted:
                 self.pred_V()
             
-            iter = int(sec_time / self._interval)
-            
-            if iter > self._am_n_interval: # in the afternoon
-                iter -= int(self._am_n_interval * 3 / 4)
+            iter = self._sec_iter[sec_time] % self._n_interval # lunch ticks go to the morning's last interval
             
             self._today_vol[iter] += volume
             self._iter = iter
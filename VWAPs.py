@@ -36,6 +36,12 @@ from statsmodels.tsa.arima_model import ARMA
 
 import warnings
 from os import listdir
+from os.path import getmtime
+from os.path import getsize
+
+from tick_store import SESSIONS
+from tick_store import seconds_from_open
+from tick_store import session_map
 
 
 def cov(a,b):
@@ -91,6 +97,83 @@ def datetime_range(T_START_TIME, T_END_TIME ,delta):
         current += delta
 
 
+# (file path, mtime, size, interval) -> summary of that version of a history file, see summarize_day
+_day_summaries = {}
+DAY_SUMMARIES_MAX_BYTES = 64 * 2 ** 20 # the least recently used summaries are dropped beyond this size
+_day_summaries_bytes = 0
+
+
+def summarize_day(file_path, interval):
+    """
+    Read one history file once and summarize it for both history windows
+
+    The summary is a dict of
+        n_tick: the number of ticks in the file
+        ca: the volume traded in the call auction
+        total: the volume traded after the opening
+        volume: the volume traded in each interval of the day
+    the entries the file is not in the expected format for are None.
+
+    Summaries are cached in the process, so a file read by the regression window
+    is never read again by the rolling window or by another VWAP. A file whose mtime
+    or size changed since, e.g. one still growing, is read again. Exceptions of the
+    csv reader are not caught. The cache holds DAY_SUMMARIES_MAX_BYTES at most,
+    the least recently used summaries are dropped first.
+    """
+
+    global _day_summaries_bytes
+
+    key = (file_path, getmtime(file_path), getsize(file_path), interval)
+    if key in _day_summaries:
+        summary = _day_summaries[key] = _day_summaries.pop(key) # now the most recently used
+        return summary
+
+    dat = pd.read_csv(file_path)
+    summary = {'n_tick': dat.shape[0], 'ca': None, 'total': None, 'volume': None}
+
+    try:
+        dat.columns = ['DateTime','Volume'] # there will be Microsecond
+        dat = np.column_stack((seconds_from_open(dat.DateTime), np.asarray(dat.Volume, dtype = float)))
+        summary['ca'] = dat[dat[:,0] < 0][:,1].sum()
+        dat = dat[dat[:,0] > 0]
+        summary['total'] = dat[:,1].sum()
+
+        # Tracey by reviewing the data from ctp finds it impossible
+        if np.any(dat[:,0] >= 198000):
+            dat = np.vstack((dat[dat[:,0]<19800],[19800,dat[dat[:,0] >= 19800,1].sum()]))
+        dat[-1,0] = 198000
+        x_input = np.append(0, dat[:,0])
+        x_output = np.append(np.arange(0 + interval , 7200 + interval, interval), 
+                            np.arange(12600 + interval,19800 + interval,interval))
+        volume_cumsum = np.append(0,dat[:,1].cumsum())
+        y_interp = scipy.interpolate.interp1d(x_input,volume_cumsum) # ,interval)
+        intraday_volume = y_interp(x_output)
+        summary['volume'] = np.append(intraday_volume[0],(intraday_volume[1:] - intraday_volume[:-1]))
+    except Exception:
+        pass
+
+    _day_summaries[key] = summary
+    _day_summaries_bytes += _summary_bytes(summary)
+    while _day_summaries_bytes > DAY_SUMMARIES_MAX_BYTES and len(_day_summaries) > 1:
+        _day_summaries_bytes -= _summary_bytes(_day_summaries.pop(next(iter(_day_summaries)))) # dicts keep insertion order
+    return summary
+
+
+def _summary_bytes(summary):
+    """Approximate memory held by a day summary: its volume array and a fixed overhead"""
+
+    return 256 + (0 if summary['volume'] is None else summary['volume'].nbytes)
+
+
+def clear_day_summaries():
+    """Forget the cached history files, e.g. when a new trading day starts"""
+
+    global _day_summaries_bytes
+
+    _day_summaries.clear()
+    _day_summaries_bytes = 0
+
+
 class VWAP(object):
     """
     a single VWAP object will track and predict one ticker
@@ -157,7 +240,9 @@ class VWAP(object):
         self._interval = interval
         self._interval_timedelta = timedelta(seconds = self._interval)
         self._semi_n_interval = int(self.HALFTIME / self._interval_timedelta)
-        self._n_interval = 2 * self._semi_n_interval
+        # the interval of each sec of the day, see tick_store.session_map
+        self._sec_iter = session_map(self._interval, SESSIONS)[1]
+        self._n_interval = self._sec_iter[-1] + 1
         self._features_to_train = np.ones((11,3),dtype=float) # CA, M, L, A
         self._histo_volume = np.full((10,self._n_interval),0, dtype=float)  # historical trading volume        
         self._intraday_percentage = [1 / self._n_interval] * self._n_interval  # notice .sum() =self._n_interval
@@ -181,8 +266,6 @@ class VWAP(object):
         
         files = set([ filename for filename in listdir(self.DATA_PATH) if filename.endswith( '.csv' ) ])
         history_date = self.TODAY
-        x_output = np.append(np.arange(0 + self._interval , 7200 + self._interval, self._interval), 
-                            np.arange(12600 + self._interval,19800 + self._interval,self._interval))
         
         past_days = 0
         iter = 1
@@ -207,12 +290,12 @@ class VWAP(object):
                 continue
 
             try:
-                dat = pd.read_csv(self.DATA_PATH+filename)
+                day = summarize_day(self.DATA_PATH + filename, self._interval)
             except Exception:
                 print('Error in reading %s, go to the previous day.' % filename)
                 continue
 
-            if dat.shape[0] < self.N_TICK_THRESHOLD:
+            if day['n_tick'] < self.N_TICK_THRESHOLD:
                 print('File %s has few data for prediction' % filename)
                 continue
 
@@ -220,33 +303,13 @@ class VWAP(object):
                 warnings.warn('Lack historical data. Time span of data for predicting intraday_volume of today has exceeded 20 days.'
                                 'We are using data %d days from today' % past_days)        
             
-            try:
-                dat.columns = ['DateTime','Volume'] # there will be Microsecond
-                dat.DateTime = [datetime.strptime(str(history_date.strftime('%Y-%m-%d')) + ' ' + dt, "%Y-%m-%d %H:%M:%S") for dt in dat.DateTime]
-                
-                # datetime to time difference
-                self.H_START_TIME = history_date.replace(hour = 9, minute = 30, second = 0, microsecond = 0)            
-                dat['TimeStamp'] = [(dt - self.H_START_TIME).total_seconds() for dt in dat.DateTime]
-                dat = dat.as_matrix(columns = ['TimeStamp','Volume'])
-                
-                datCA = dat[dat[:,0] < 0]
-                self._features_to_train[10 - iter,0] = datCA[:,1].sum()
-                dat = dat[dat[:,0] > 0]
-
-                # Tracey by reviewing the data from ctp finds it impossible
-                if any(t >= 198000 for t in dat[:,0]):
-                    dat = np.vstack((dat[dat[:,0]<19800],[19800,dat[dat[:,0] >= 19800,1].sum()]))
-                dat[-1,0] = 198000
-                x_input = np.append(0, dat[:,0])
-                volume_cumsum = np.append(0,dat[:,1].cumsum())
-                y_interp = scipy.interpolate.interp1d(x_input,volume_cumsum) # ,interval)
-                intraday_volume = y_interp(x_output)
-                intraday_volume = np.append(intraday_volume[0],(intraday_volume[1:] - intraday_volume[:-1]))
-                self._histo_volume[10 - iter] = intraday_volume
-            except Exception:
+            if day['volume'] is None:
                 print('Error when read file %s, you may check its format' % filename)
                 continue
 
+            self._features_to_train[10 - iter,0] = day['ca']
+            self._histo_volume[10 - iter] = day['volume']
+
             iter += 1
 
         iter = 11 # 这个不需要
@@ -273,7 +336,7 @@ class VWAP(object):
                 continue
 
             try:
-                dat = pd.read_csv(self.DATA_PATH+filename)
+                day = summarize_day(self.DATA_PATH + filename, self._interval)
             except Exception:
                 print('Error in reading %s, go to the previous day.' % filename)
                 continue
@@ -281,16 +344,11 @@ class VWAP(object):
             if past_days > 30:
                 warnings.warn('Lack historical data. Time span of data for predicting total trading volume of today has exceeded 30 days.')        
             
-            try:
-                dat = pd.read_csv(self.DATA_PATH+filename)
-                dat.columns = ['DateTime','Volume']
-                self.H_START_TIME = history_date.replace(hour = 9, minute = 30, second = 0, microsecond = 0)
-                dat.DateTime = [datetime.strptime(str(history_date.strftime('%Y-%m-%d')) + ' ' + dt, 
-                                                        "%Y-%m-%d %H:%M:%S") for dt in dat.DateTime]
-                volume_sums[15 - iter] = dat[dat.DateTime > self.H_START_TIME].Volume.sum()
-            except Exception:
+            if day['total'] is None:
                 print('Error when read file '+ filename + ', you may check its format')
                 continue
+
+            volume_sums[15 - iter] = day['total']
             
             iter += 1
 
@@ -347,10 +405,7 @@ class VWAP(object):
             if not self.is_V_predicted:
                 self.pred_V()
             
-            iter = int((date_time - self.T_START_TIME) / self.INTERVAL)
-            
-            if iter > (self._semi_n_interval): # in the afternoon
-                iter -= int(self._n_interval  * 3 / 8)
+            iter = self._sec_iter[int((date_time - self.T_START_TIME).total_seconds())] % self._n_interval # lunch ticks go to the morning's last interval
             self._today_vol[iter] += volume
             self._iter = iter
             
@@ -0,0 +1,921 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar binary store for historical tick data.
+
+The handlers read their history from a tree of csv files
+
+    DATA_PATH/YYYYMMDD/TICKER.csv     (columns: Nano, Volume)
+
+(a file may also be a gzip or zstd archive, TICKER.csv.gz or TICKER.csv.zst,
+decompressed as a stream while it is read; zstd needs the zstandard package)
+and parsing those csv files is most of the start-up cost of a VWAP_handler.
+convert_tick_tree mirrors the tree into STORE_PATH/YYYYMMDD/TICKER.npz, each
+file holding the Nano and Volume columns as raw int64 arrays, and read_ticks
+serves a (day, ticker) from the store, falling back to the csv file whenever
+the binary file is missing or unreadable.
+
+chunk_buckets summarizes a day of ticks into its volume in 5-sec buckets while
+reading it in chunks (read_tick_chunks), so that even the largest files take
+bounded memory. convert_bucket_tree goes one step further and stores each
+(day, ticker) as its 5-sec bucket volumes (STORE_PATH/YYYYMMDD/TICKER_5s.npz)
+together with the call auction volume, the session total and the number of
+ticks. Since every
+interval a VWAP accepts is a multiple of 5 secs, interval_volume turns the 5-sec
+buckets into the intraday profile of any interval without touching the ticks.
+
+The trading calendar (STORE_PATH/calendar.pkl) indexes the tree itself: for each
+ticker the sorted dates it has a file for and, for each file, its number of
+ticks, call auction volume, session total, first and last Nano, mtime and size.
+It is built once and then updated for the files new or changed. History loaders
+take their candidate days from it by slicing instead of probing the directories
+day by day, and skip the files too short or without call auction, and read no
+file at all for the days they only need the session total of.
+
+The tick journal is the live counterpart of the tree: TickJournal appends the
+(ticker, nano, cum_volume) of every tick pushed to a handler to a binary file,
+in batches, and read_journal gives the records back as one array so that a
+restarted handler can replay its day. The first record of a journal is a header
+holding its trading day (journal_day), so that a journal left from another day
+is not replayed into today.
+
+Example:
+    convert_tick_tree('./data_path/', './store_path/')
+    dat = read_ticks('./data_path/', '20170713', 'SH600884', './store_path/')
+
+    convert_bucket_tree('./data_path/', './store_path/')
+    day = read_buckets('./store_path/', '20170713', 'SH600884')
+    intraday_volume = interval_volume(day['volume'], 60)
+
+    calendar = load_calendar('./store_path/')
+    if update_calendar('./data_path/', calendar, before = '20170713'):
+        save_calendar('./store_path/', calendar)
+    days = trading_days(calendar, 'SH600884', '20170713', n_tick_threshold = 1000)
+
+    journal = TickJournal('./journal_20170713.bin')
+    journal.append('SH600884', 1499909402000000000, 1200)
+    journal.close()
+    records = read_journal('./journal_20170713.bin')
+"""
+
+import numpy as np
+import pandas as pd
+
+import time
+import gzip
+import pickle
+import zipfile
+from bisect import bisect_left
+from datetime import datetime
+from datetime import time as dt_time
+from math import ceil
+
+from os import listdir
+from os import makedirs
+from os import rename
+from os.path import getmtime
+from os.path import getsize
+from os.path import isdir
+from os.path import isfile
+
+TICK_COLUMNS = ['Nano', 'Volume']
+TICK_SUFFIXES = ('.csv', '.csv.gz', '.csv.zst') # plain first, archives are read as streams
+
+BUCKET = 5 # secs
+NANO = 10 ** 9 # nanos per sec, ticks are stamped in epoch nanos
+AM_END_SECS = 7200 # 11:30:00, in secs from the opening
+PM_START_SECS = 12600 # 13:00:00
+SESSION_END_SECS = 19800 # 15:00:00, the last tick of a day is moved here
+SESSIONS = ((0, AM_END_SECS), (PM_START_SECS, SESSION_END_SECS)) # (open, close) of the trading sessions
+
+CHUNK_ROWS = 100000 # ticks held in memory at once by the streaming readers
+
+CALENDAR_FILE = 'calendar.pkl'
+CALENDAR_VERSION = 2
+META_FIELDS = ('n_tick', 'ca', 'total', 'first_nano', 'last_nano', 'mtime', 'size')
+
+JOURNAL_DTYPE = np.dtype([('ticker', 'S16'), ('nano', '<i8'), ('cum_volume', '<i8')])
+JOURNAL_HEADER = b'#journal' # ticker of the header record, its nano holds the day as YYYYMMDD
+
+
+def seconds_from_open(times, open_secs = 34200):
+    """
+    Secs from the market opening (9:30:00) of a column of 'HH:MM:SS' strings
+
+    Zero-padded strings are parsed as fixed-width digits for the whole column
+    at once, anything else goes through pd.to_timedelta. Raises ValueError on a
+    time that can not be parsed or is missing, like strptime did.
+    """
+
+    chars = np.asarray(times, dtype = 'U9').view(np.uint32).reshape(-1, 9).astype(np.int64) - ord('0')
+    digits = chars[:, [0, 1, 3, 4, 6, 7]]
+    if np.all(chars[:, [2, 5]] == ord(':') - ord('0')) and np.all(chars[:, 8] == -ord('0')) and np.all((digits >= 0) * (digits <= 9)):
+        secs = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 2] * 10 + digits[:, 3]) * 60 + digits[:, 4] * 10 + digits[:, 5]
+    else:
+        times = pd.Series(times)
+        if not times.str.match(r'^\d{1,2}:\d{1,2}:\d{1,2}(\.\d*)?$').fillna(False).all():
+            raise ValueError('time not in HH:MM:SS in the column')
+        secs = pd.to_timedelta(times, errors = 'raise').dt.total_seconds().values
+
+    return np.asarray(secs, dtype = float) - open_secs
+
+
+def csv_file(data_path, date_str, ticker):
+
+    return data_path + date_str + '/' + ticker + '.csv'
+
+
+def tick_file(data_path, date_str, ticker):
+    """The tick file of a (day, ticker), plain csv or compressed, the plain csv path if there is none"""
+
+    for suffix in TICK_SUFFIXES:
+        path = data_path + date_str + '/' + ticker + suffix
+        if isfile(path):
+            return path
+
+    return csv_file(data_path, date_str, ticker)
+
+
+def file_ticker(filename):
+    """The ticker of a tick file name, None if it is not one"""
+
+    for suffix in TICK_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+
+    return None
+
+
+def open_tick_file(path):
+    """A binary file object reading a tick file, decompressed on the fly for .gz and .zst"""
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+
+    if path.endswith('.zst'):
+        import zstandard # optional, only needed for a zstd archive
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_size = 1 << 20)
+
+    return open(path, 'rb')
+
+
+def npz_file(store_path, date_str, ticker):
+
+    return store_path + date_str + '/' + ticker + '.npz'
+
+
+def buckets_file(store_path, date_str, ticker):
+
+    return store_path + date_str + '/' + ticker + '_5s.npz'
+
+
+def tree_files(data_path, dates = None):
+    """(date_str, ticker) of every csv file under data_path, by date"""
+
+    if dates is None:
+        dates = [d for d in listdir(data_path) if isdir(data_path + d)]
+
+    for date_str in sorted(dates):
+        tickers = set(file_ticker(filename) for filename in listdir(data_path + date_str))
+        tickers.discard(None)
+        for ticker in sorted(tickers):
+            yield date_str, ticker
+
+
+def is_up_to_date(dst, src):
+
+    return isfile(dst) and getmtime(dst) >= getmtime(src)
+
+
+def convert_tick_file(csv_path, npz_path):
+    """Write the Nano and Volume columns of one csv file as int64 arrays"""
+
+    with open_tick_file(csv_path) as f:
+        dat = pd.read_csv(f, header = 0)
+    np.savez(npz_path, Nano = np.asarray(dat.Nano, dtype = np.int64),
+             Volume = np.asarray(dat.Volume, dtype = np.int64))
+
+
+def convert_tick_tree(data_path, store_path, dates = None, overwrite = False):
+    """
+    Mirror DATA_PATH/YYYYMMDD/TICKER.csv into STORE_PATH/YYYYMMDD/TICKER.npz
+
+    Args:
+        data_path (str): root of the csv tree, ending with a slash
+        store_path (str): root of the binary store, ending with a slash
+        dates (list of str): only convert these YYYYMMDD directories, default all
+        overwrite (bool): convert again even if the binary file is up to date
+
+    Returns:
+        the number of files converted
+    """
+
+    n_converted = 0
+    for date_str, ticker in tree_files(data_path, dates):
+        if not isdir(store_path + date_str):
+            makedirs(store_path + date_str)
+
+        src = tick_file(data_path, date_str, ticker)
+        dst = npz_file(store_path, date_str, ticker)
+        if not overwrite and is_up_to_date(dst, src):
+            continue
+
+        try:
+            convert_tick_file(src, dst)
+        except Exception:
+            print('Error in converting %s, it will be read from csv.' % src)
+            continue
+
+        n_converted += 1
+
+    return n_converted
+
+
+def read_ticks(data_path, date_str, ticker, store_path = None):
+    """
+    Tick data of one ticker at one day as a DataFrame with columns Nano and Volume
+
+    The binary store is tried first when store_path is given, the csv file under
+    data_path is the fallback. Exceptions of the csv reader are not caught.
+    """
+
+    if store_path is not None:
+        try:
+            with np.load(npz_file(store_path, date_str, ticker)) as dat:
+                return pd.DataFrame({'Nano': dat['Nano'], 'Volume': dat['Volume']}, columns = TICK_COLUMNS)
+        except Exception:
+            pass
+
+    with open_tick_file(tick_file(data_path, date_str, ticker)) as f:
+        return pd.read_csv(f, header = 0)
+
+
+def read_tick_chunks(data_path, date_str, ticker, store_path = None, chunksize = CHUNK_ROWS):
+    """
+    Tick data of one ticker at one day as DataFrames of at most chunksize rows
+
+    Like read_ticks the binary store is tried first; either way only one chunk is
+    in memory, the arrays of a binary file are read slice by slice from the archive
+    and a csv file is parsed chunk by chunk. Opening errors of the csv reader are
+    not caught.
+    """
+
+    if store_path is not None:
+        try:
+            return _npz_chunks(npz_file(store_path, date_str, ticker), chunksize)
+        except Exception:
+            pass
+
+    return _csv_chunks(tick_file(data_path, date_str, ticker), chunksize)
+
+
+def _npz_chunks(path, chunksize):
+
+    archive = zipfile.ZipFile(path)
+    files = []
+    dtypes = []
+    try:
+        for name in TICK_COLUMNS:
+            f = archive.open(name + '.npy')
+            files.append(f)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            if len(shape) != 1 or (dtypes and shape[0] != n_row):
+                raise ValueError('%s does not hold two columns of ticks' % path)
+            n_row = shape[0]
+            dtypes.append(dtype)
+    except Exception:
+        for f in files:
+            f.close()
+        archive.close()
+        raise
+
+    def chunks():
+        try:
+            for i in range(0, max(n_row, 1), chunksize):
+                n = min(chunksize, n_row - i)
+                yield pd.DataFrame(dict((name, np.frombuffer(f.read(n * dtype.itemsize), dtype = dtype))
+                                        for name, f, dtype in zip(TICK_COLUMNS, files, dtypes)), columns = TICK_COLUMNS)
+        finally:
+            for f in files:
+                f.close()
+            archive.close()
+
+    return chunks()
+
+
+def _csv_chunks(path, chunksize):
+
+    f = open_tick_file(path)
+    try:
+        reader = pd.read_csv(f, header = 0, chunksize = chunksize)
+    except Exception:
+        f.close()
+        raise
+
+    def chunks():
+        try:
+            for dat in reader:
+                yield dat
+        finally:
+            f.close()
+
+    return chunks()
+
+
+def _interp(x, y, x_new):
+    """interp1d's linear interpolation, with x sorted and x[0] < x_new <= x[-1]"""
+
+    hi = np.clip(np.searchsorted(x, x_new, side = 'left'), 1, len(x) - 1)
+    lo = hi - 1
+    slope = (y[hi] - y[lo]) / (x[hi] - x[lo])
+
+    return slope * (x_new - x[lo]) + y[lo]
+
+
+class _BucketCurve(object):
+    """
+    The cumulative volume curve of chunk_buckets, evaluated at the bucket ends as ticks come
+
+    Points are the ticks after the opening, except that ticks in the first 30 secs of the
+    lunch break are merged at the end of the morning if any falls strictly inside, ticks
+    from SESSION_END_SECS on are merged there and the last point is moved there. The last point is held back until the next one arrives since it may be moved.
+    """
+
+    def __init__(self, t_end_secs):
+
+        self.x_output = np.concatenate((np.arange(BUCKET, AM_END_SECS + BUCKET, BUCKET),
+                                        np.arange(PM_START_SECS + BUCKET, t_end_secs, BUCKET), np.array([t_end_secs])), axis = 0)
+        self.cum_buckets = np.zeros(len(self.x_output))
+        self.n_done = 0 # bucket ends evaluated
+        self.anchor = (0., 0.) # last point whose place is final
+        self.held = None
+        self.y = 0.
+        self.lunch_sum = 0.
+        self.lunch_inside = False
+        self.lunch_edge = [] # ticks at the very ends of the 30 secs, kept if nothing is merged
+        self.lunch_done = False
+        self.close_sum = 0.
+        self.close_any = False
+
+    def add(self, sec, volume):
+        """Ticks after the opening, in time order"""
+
+        self._emit(sec[sec < AM_END_SECS], volume[sec < AM_END_SECS])
+
+        lunch = (sec >= AM_END_SECS) * (sec <= AM_END_SECS + 30)
+        if np.any(lunch):
+            self.lunch_sum += volume[lunch * (sec < AM_END_SECS + 30)].sum()
+            self.lunch_inside = self.lunch_inside or bool(np.any((sec > AM_END_SECS) * (sec < AM_END_SECS + 30)))
+            edge = lunch * ((sec == AM_END_SECS) + (sec == AM_END_SECS + 30))
+            self.lunch_edge.extend(zip(sec[edge].tolist(), volume[edge].tolist()))
+
+        later = sec > AM_END_SECS + 30
+        if np.any(later):
+            self._end_lunch()
+            pm = later * (sec < SESSION_END_SECS)
+            self._emit(sec[pm], volume[pm])
+            if np.any(sec >= SESSION_END_SECS):
+                self.close_sum += volume[sec >= SESSION_END_SECS].sum()
+                self.close_any = True
+
+    def finish(self):
+        """The cumulative volume at every bucket end"""
+
+        self._end_lunch()
+        if self.close_any:
+            self._emit(np.array([SESSION_END_SECS], dtype = float), np.array([self.close_sum]))
+        if self.held is None:
+            raise ValueError('no tick after the opening')
+
+        self._interp_upto(np.array([self.anchor[0], SESSION_END_SECS]), np.array([self.anchor[1], self.held[1]]))
+        if self.n_done < len(self.x_output):
+            raise ValueError('bucket ends beyond the last tick')
+
+        return self.cum_buckets
+
+    def _end_lunch(self):
+
+        if self.lunch_done:
+            return
+        self.lunch_done = True
+
+        if self.lunch_inside:
+            self._emit(np.array([AM_END_SECS], dtype = float), np.array([self.lunch_sum]))
+        elif self.lunch_edge:
+            self._emit(np.array([e[0] for e in self.lunch_edge]), np.array([e[1] for e in self.lunch_edge], dtype = float))
+
+    def _emit(self, x, volume):
+
+        if len(x) == 0:
+            return
+
+        y = self.y + volume.cumsum()
+        self.y = y[-1]
+
+        if self.held is None:
+            px = np.append(self.anchor[0], x)
+            py = np.append(self.anchor[1], y)
+        else:
+            px = np.concatenate(([self.anchor[0], self.held[0]], x))
+            py = np.concatenate(([self.anchor[1], self.held[1]], y))
+
+        self._interp_upto(px[:-1], py[:-1])
+        self.anchor = (px[-2], py[-2])
+        self.held = (px[-1], py[-1])
+
+    def _interp_upto(self, x, y):
+
+        if len(x) < 2:
+            return
+
+        n = np.searchsorted(self.x_output, x[-1], side = 'right')
+        if n > self.n_done:
+            self.cum_buckets[self.n_done:n] = _interp(x, y, self.x_output[self.n_done:n])
+            self.n_done = n
+
+
+def _tick_volumes(chunks, histo_date):
+    """(nano, secs from the opening, volume) arrays of each non-empty chunk of a day's ticks"""
+
+    t_start = time.mktime(datetime.combine(histo_date, dt_time(hour = 9, minute = 30, second = 0, microsecond = 0)).timetuple())
+    last_cum_volume = None
+
+    for dat in chunks:
+        if len(dat) == 0:
+            continue
+
+        nano = np.asarray(dat.Nano)
+        cum_volume = np.asarray(dat.Volume, dtype = float)
+        volume = np.append(cum_volume[0] if last_cum_volume is None else cum_volume[0] - last_cum_volume,
+                           cum_volume[1:] - cum_volume[:-1])
+        last_cum_volume = cum_volume[-1]
+
+        yield nano, nano / 1e9 - t_start, volume
+
+
+def chunk_buckets(chunks, histo_date, t_end_secs = SESSION_END_SECS):
+    """
+    Summarize one day of ticks the way VWAP reads its history
+
+    Memory is bounded by the size of a chunk whatever the size of the day.
+
+    Args:
+        chunks: DataFrames with columns Nano and Volume (cumulative) in time order, as
+            given by read_tick_chunks; a whole day in one DataFrame is fine as well
+        histo_date (date): the trading day of the ticks
+        t_end_secs (int): market close in secs from the opening, a multiple of BUCKET
+
+    Returns:
+        a dict of
+            n_tick: the number of ticks
+            ca: the volume traded in the call auction
+            total: the volume traded between the opening and t_end_secs
+            volume: the volume traded in each 5-sec bucket from the opening to t_end_secs,
+                the first afternoon bucket includes the lunch break
+    """
+
+    if t_end_secs % BUCKET != 0:
+        raise ValueError('market close must be a multiple of %d secs from the opening' % BUCKET)
+
+    curve = _BucketCurve(t_end_secs)
+    n_tick = 0
+    ca = 0.
+    total = 0.
+
+    for _, sec, volume in _tick_volumes(chunks, histo_date):
+        n_tick += len(sec)
+        ca += volume[sec < 0].sum()
+        total += volume[(sec > 0) * (sec < t_end_secs)].sum()
+        curve.add(sec[sec > 0], volume[sec > 0])
+
+    cum_buckets = curve.finish()
+
+    return {
+        'n_tick': n_tick,
+        'ca': ca,
+        'total': total,
+        'volume': np.append(cum_buckets[0], cum_buckets[1:] - cum_buckets[:-1])
+    }
+
+
+def day_buckets(dat, histo_date, t_end_secs = SESSION_END_SECS):
+    """chunk_buckets of a whole day of ticks in one DataFrame"""
+
+    return chunk_buckets([dat], histo_date, t_end_secs)
+
+
+def day_sessions(t_end_secs, sessions = None):
+    """
+    The trading sessions of a day closing at t_end_secs
+
+    sessions (default SESSIONS) are cut at the close and the last one is moved to end
+    there, so a market close earlier or later than 15:00 only changes the last session.
+
+    Returns:
+        a tuple of (open, close) in secs from the opening, multiples of BUCKET
+    """
+
+    sessions = [(int(start), int(min(end, t_end_secs))) for start, end in (SESSIONS if sessions is None else sessions)
+                if start < t_end_secs]
+    if not sessions:
+        raise ValueError('no trading session before the market close')
+    sessions[-1] = (sessions[-1][0], int(t_end_secs))
+
+    last_end = 0
+    for start, end in sessions:
+        if start < last_end or end <= start:
+            raise ValueError('trading sessions must be in time order and must not overlap')
+        if start % BUCKET != 0 or end % BUCKET != 0:
+            raise ValueError('trading sessions must open and close at multiples of %d secs' % BUCKET)
+        last_end = end
+
+    return tuple(sessions)
+
+
+def check_bucket_sessions(sessions):
+    """
+    Raise ValueError unless the 5-sec buckets of day_buckets cover every trading session
+
+    The buckets run from the opening to AM_END_SECS and from PM_START_SECS to the close,
+    so a session trading in the lunch break between them would get no history volume.
+    """
+
+    for start, end in sessions:
+        if start < PM_START_SECS and end > AM_END_SECS:
+            raise ValueError('trading sessions must not trade between %d and %d secs, the lunch break has no 5-sec buckets'
+                             % (AM_END_SECS, PM_START_SECS))
+
+
+_session_maps = {} # session_map by (interval, sessions), shared by all the VWAP objects of a day
+
+
+def session_map(interval, sessions = SESSIONS):
+    """
+    The interval of each sec from the opening to the close of the last session
+
+    Every session is cut into intervals from its own opening, its last interval cut short
+    by its close. A sec in a break is given the interval its ticks are booked into, the
+    last one before the break like the lunch ticks of chunk_buckets (the first interval
+    before the first session), less the number of intervals: a negative marker from
+    which the interval is still found.
+
+    Returns:
+        (map, list), the map as an int64 array for batches and as a list for single
+        ticks, both shared and not to be modified
+    """
+
+    key = (interval, tuple(sessions))
+    if key not in _session_maps:
+        n_intervals = [int(ceil((end - start) / float(interval))) for start, end in sessions]
+        n_interval = sum(n_intervals)
+        sec_iter = np.empty(sessions[-1][1], dtype = np.int64)
+        first = 0
+        last_end = 0
+        for (start, end), n in zip(sessions, n_intervals):
+            sec_iter[last_end:start] = max(first - 1, 0) - n_interval
+            sec_iter[start:end] = first + np.arange(end - start) // interval
+            first += n
+            last_end = end
+        _session_maps[key] = (sec_iter, sec_iter.tolist())
+
+    return _session_maps[key]
+
+
+_volume_layouts = {} # _bucket_layout by (interval, sessions, number of buckets)
+
+
+def _bucket_layout(n_bucket, interval, sessions = None):
+    """
+    How interval_volume sums n_bucket 5-sec buckets into the intervals of session_map
+
+    Returns:
+        (n_interval, width, gather): the buckets of each interval make a row of width,
+        by a reshape if gather is None, else by indexing the buckets with an extra 0
+        appended with gather, where the rows of the intervals with fewer buckets are
+        padded with that 0. Shared and not to be modified.
+    """
+
+    key = (interval, None if sessions is None else tuple(tuple(session) for session in sessions), n_bucket)
+    if key not in _volume_layouts:
+        n_am = AM_END_SECS // BUCKET
+        starts = np.append(np.arange(0, AM_END_SECS, BUCKET), PM_START_SECS + BUCKET * np.arange(n_bucket - n_am))
+        day = day_sessions(starts[-1] + BUCKET, sessions)
+        check_bucket_sessions(day)
+        sec_iter = session_map(interval, day)[0]
+        n_interval = int(sec_iter[-1]) + 1
+        iters = sec_iter[starts] % n_interval
+
+        first = np.searchsorted(iters, np.arange(n_interval))
+        counts = np.diff(np.append(first, len(iters)))
+        width = max(interval // BUCKET, counts.max())
+        if np.all(counts == width): # every interval full, e.g. intervals dividing the sessions
+            gather = None
+        else:
+            rows = first[:, None] + np.arange(width)
+            gather = np.where(np.arange(width) < counts[:, None], rows, n_bucket)
+        _volume_layouts[key] = (n_interval, width, gather)
+
+    return _volume_layouts[key]
+
+
+def interval_volume(volume, interval, sessions = None):
+    """
+    Intraday profile at a given interval from the 5-sec bucket volumes of day_buckets
+
+    interval must be a multiple of BUCKET. The buckets are put in the intervals of
+    session_map, for the sessions (default SESSIONS) of a day closing where the buckets
+    end; buckets in a break go to the interval before it, like the ticks of VWAP.
+    Sessions trading in the lunch break, which has no buckets, raise ValueError.
+    """
+
+    if interval % BUCKET != 0:
+        raise ValueError('interval must be a multiple of %d secs' % BUCKET)
+
+    n_interval, width, gather = _bucket_layout(len(volume), interval, sessions)
+    if gather is None:
+        return np.asarray(volume, dtype = float).reshape(n_interval, width).sum(axis = 1)
+
+    return np.append(volume, 0.)[gather].sum(axis = 1)
+
+
+def convert_bucket_tree(data_path, store_path, dates = None, overwrite = False):
+    """
+    Summarize DATA_PATH/YYYYMMDD/TICKER.csv into STORE_PATH/YYYYMMDD/TICKER_5s.npz
+
+    Ticks are taken from the binary tick store under store_path when it is there.
+    The buckets run to the standard close SESSION_END_SECS.
+
+    Returns:
+        the number of files summarized
+    """
+
+    n_converted = 0
+    for date_str, ticker in tree_files(data_path, dates):
+        if not isdir(store_path + date_str):
+            makedirs(store_path + date_str)
+
+        src = tick_file(data_path, date_str, ticker)
+        dst = buckets_file(store_path, date_str, ticker)
+        if not overwrite and is_up_to_date(dst, src):
+            continue
+
+        try:
+            day = chunk_buckets(read_tick_chunks(data_path, date_str, ticker, store_path), datetime.strptime(date_str, '%Y%m%d').date())
+            np.savez(dst, **day)
+        except Exception:
+            print('Error in summarizing %s, it will be read from ticks.' % src)
+            continue
+
+        n_converted += 1
+
+    return n_converted
+
+
+def read_buckets(store_path, date_str, ticker):
+    """The day_buckets dict of one ticker at one day from the bucket store, None if it is not there"""
+
+    try:
+        with np.load(buckets_file(store_path, date_str, ticker)) as dat:
+            return {
+                'n_tick': int(dat['n_tick']),
+                'ca': float(dat['ca']),
+                'total': float(dat['total']),
+                'volume': dat['volume']
+            }
+    except Exception:
+        return None
+
+
+def file_meta(path, histo_date):
+    """
+    What the trading calendar keeps of a tick file, read in chunks
+
+    Returns:
+        a dict of n_tick, ca and total (as in chunk_buckets with the standard close),
+        first_nano and last_nano (-1 for an empty file), mtime and size
+    """
+
+    meta = {'n_tick': 0, 'ca': 0., 'total': 0., 'first_nano': -1, 'last_nano': -1,
+            'mtime': getmtime(path), 'size': getsize(path)}
+
+    for nano, sec, volume in _tick_volumes(_csv_chunks(path, CHUNK_ROWS), histo_date):
+        if meta['n_tick'] == 0:
+            meta['first_nano'] = int(nano[0])
+        meta['last_nano'] = int(nano[-1])
+        meta['n_tick'] += len(sec)
+        meta['ca'] += volume[sec < 0].sum()
+        meta['total'] += volume[(sec > 0) * (sec < SESSION_END_SECS)].sum()
+
+    return meta
+
+
+def load_calendar(store_path):
+    """
+    The trading calendar saved under store_path, an empty one if there is none
+
+    A calendar is a dict of
+        version: CALENDAR_VERSION, calendars of other versions are built again
+        dates: the sorted date directories indexed so far
+        dir_mtimes: a dict of date to the mtime of its directory when it was last indexed
+        tickers: a dict of ticker to a dict of lists, 'dates' sorted and, for each of
+            them, the META_FIELDS of file_meta
+    """
+
+    try:
+        with open(store_path + CALENDAR_FILE, 'rb') as f:
+            calendar = pickle.load(f)
+        if calendar.get('version') == CALENDAR_VERSION:
+            return calendar
+    except Exception:
+        pass
+
+    return {'version': CALENDAR_VERSION, 'dates': [], 'dir_mtimes': {}, 'tickers': {}}
+
+
+def save_calendar(store_path, calendar):
+
+    if not isdir(store_path):
+        makedirs(store_path)
+
+    with open(store_path + CALENDAR_FILE + '.tmp', 'wb') as f:
+        pickle.dump(calendar, f, 2)
+    rename(store_path + CALENDAR_FILE + '.tmp', store_path + CALENDAR_FILE)
+
+
+def update_calendar(data_path, calendar, before = None, full = False):
+    """
+    Index the tick files of data_path that are new or changed since the calendar last saw them
+
+    Only the date directories whose mtime changed since they were indexed are listed,
+    i.e. those with files added, removed or replaced; in those a file is read again
+    only when its mtime or size changed, files gone are dropped.
+
+    Args:
+        before (str): YYYYMMDD, leave this day and later out, e.g. today whose files are still growing
+        full (bool): check every file of every date, for files rewritten in place
+
+    Returns:
+        the number of date directories listed, 0 when the calendar is unchanged
+    """
+
+    dates = sorted(d for d in listdir(data_path) if len(d) == 8 and d.isdigit()
+                   and (before is None or d < before) and isdir(data_path + d))
+    dir_mtimes = calendar.setdefault('dir_mtimes', {})
+    dir_mtime = dict((date_str, getmtime(data_path + date_str)) for date_str in dates)
+    scanned = [date_str for date_str in dates if full or dir_mtimes.get(date_str) != dir_mtime[date_str]]
+
+    seen = set()
+    failed = set()
+    for date_str, ticker in tree_files(data_path, scanned):
+        seen.add((ticker, date_str))
+        path = tick_file(data_path, date_str, ticker)
+        days = calendar['tickers'].setdefault(ticker, dict((field, []) for field in ('dates',) + META_FIELDS))
+        i = bisect_left(days['dates'], date_str)
+        known = i < len(days['dates']) and days['dates'][i] == date_str
+        if known and days['mtime'][i] == getmtime(path) and days['size'][i] == getsize(path):
+            continue
+
+        try:
+            meta = file_meta(path, datetime.strptime(date_str, '%Y%m%d').date())
+        except Exception:
+            failed.add(date_str) # listed again next time
+            continue
+
+        if not known:
+            for field in ('dates',) + META_FIELDS:
+                days[field].insert(i, None)
+        days['dates'][i] = date_str
+        for field in META_FIELDS:
+            days[field][i] = meta[field]
+
+    scanned = set(scanned)
+    for ticker, days in calendar['tickers'].items():
+        for i in reversed(range(len(days['dates']))):
+            if days['dates'][i] in scanned and (ticker, days['dates'][i]) not in seen:
+                for field in ('dates',) + META_FIELDS:
+                    del days[field][i]
+
+    for date_str in scanned.difference(failed):
+        dir_mtimes[date_str] = dir_mtime[date_str]
+    calendar['dates'] = sorted(set(calendar['dates']).union(dates))
+
+    return len(scanned)
+
+
+def sub_calendar(calendar, tickers):
+    """The calendar cut down to tickers, e.g. for a worker that loads only those"""
+
+    return {'version': calendar['version'], 'dates': calendar['dates'],
+            'tickers': dict((ticker, calendar['tickers'][ticker]) for ticker in tickers if ticker in calendar['tickers'])}
+
+
+def trading_days(calendar, ticker, before, n_tick_threshold = 0):
+    """The dates before `before` (YYYYMMDD) with at least n_tick_threshold ticks of ticker, newest first"""
+
+    days = calendar['tickers'].get(ticker)
+    if days is None:
+        return
+
+    for i in range(bisect_left(days['dates'], before) - 1, -1, -1):
+        if days['n_tick'][i] >= n_tick_threshold:
+            yield days['dates'][i]
+
+
+def day_meta(calendar, ticker, date_str):
+    """The file_meta the calendar holds for a (day, ticker), None if it has none"""
+
+    days = calendar['tickers'].get(ticker)
+    if days is None:
+        return None
+
+    i = bisect_left(days['dates'], date_str)
+    if i == len(days['dates']) or days['dates'][i] != date_str:
+        return None
+
+    return dict((field, days[field][i]) for field in META_FIELDS)
+
+
+def trading_days_back(calendar, date_str, before):
+    """How many trading days of the calendar from date_str up to, not including, before"""
+
+    return bisect_left(calendar['dates'], before) - bisect_left(calendar['dates'], date_str)
+
+
+class TickJournal(object):
+    """
+    Append-only binary journal of ticks, records of JOURNAL_DTYPE
+
+    Ticks are buffered and written flush_every at a time, so a crash loses at most
+    the last batch; a torn record left at the end of the file is cut on reopening.
+    A new journal opened with a day starts with a header record of that day, which
+    n_record and read_journal leave out. append raises ValueError on a tick the
+    records can not hold as it is, a ticker over 16 bytes or a volume or nano that
+    is not a whole number, so that a replay never differs from the live state.
+    """
+
+    def __init__(self, file_path, flush_every = 1000, day = None):
+
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self._buffer = []
+
+        n_byte = getsize(file_path) if isfile(file_path) else 0
+        self.n_record = n_byte // JOURNAL_DTYPE.itemsize
+        if n_byte != self.n_record * JOURNAL_DTYPE.itemsize:
+            with open(file_path, 'r+b') as f:
+                f.truncate(self.n_record * JOURNAL_DTYPE.itemsize)
+        self._file = open(file_path, 'ab')
+
+        if self.n_record == 0 and day is not None:
+            np.array([(JOURNAL_HEADER, int(day.strftime('%Y%m%d')), 0)], dtype = JOURNAL_DTYPE).tofile(self._file)
+            self._file.flush()
+        elif self.n_record > 0 and journal_day(file_path) is not None:
+            self.n_record -= 1
+
+    def append(self, ticker, nano, cum_volume):
+
+        if len(ticker) > JOURNAL_DTYPE['ticker'].itemsize:
+            raise ValueError('ticker %s is too long for the journal' % ticker)
+        if int(nano) != nano or int(cum_volume) != cum_volume:
+            raise ValueError('nano %r and cum_volume %r of %s must be whole numbers for the journal' % (nano, cum_volume, ticker))
+
+        self._buffer.append((ticker, nano, cum_volume))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+
+        if self._buffer:
+            np.array(self._buffer, dtype = JOURNAL_DTYPE).tofile(self._file)
+            self._file.flush()
+            self.n_record += len(self._buffer)
+            self._buffer = []
+
+    def close(self):
+
+        self.flush()
+        self._file.close()
+
+
+def journal_day(file_path):
+    """The trading day in the header of a tick journal, None if it has no header"""
+
+    header = np.fromfile(file_path, dtype = JOURNAL_DTYPE, count = 1)
+    if len(header) == 0 or header['ticker'][0] != JOURNAL_HEADER:
+        return None
+
+    return datetime.strptime(str(header['nano'][0]), '%Y%m%d').date()
+
+
+def read_journal(file_path):
+    """The whole tick records of a tick journal as a JOURNAL_DTYPE array, in the order written"""
+
+    records = np.fromfile(file_path, dtype = JOURNAL_DTYPE, count = getsize(file_path) // JOURNAL_DTYPE.itemsize)
+    if len(records) > 0 and records['ticker'][0] == JOURNAL_HEADER:
+        records = records[1:]
+
+    return records
@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the history loading and tick processing paths of the VWAP modules.
+
+Each benchmark prints its timings and can be run from the command line:
+
+    python vwap_bench.py tick_store ./data_path/ ./store_path/ 20170713
+    python vwap_bench.py buckets ./data_path/ ./store_path/ 20170713
+    python3 vwap_bench.py timestamps ./VWAP_data_path/SH000019/
+    python vwap_bench.py batch_history ./data_path/ 20170713
+    python vwap_bench.py pool ./data_path/ 20170713 1,2,4,8
+    python vwap_bench.py compressed ./data_path/ ./archive_path/
+    python vwap_bench.py ar1 2000 480
+    python vwap_bench.py lasso 2000
+    python vwap_bench.py first_tick ./data_path/ 20170713
+    python vwap_bench.py rolling 2000 15 5
+    python vwap_bench.py replay ./data_path/ 20170713 5,30,300
+    python vwap_bench.py book ./data_path/ 20170713 4000 3
+    python vwap_bench.py bucket 1000000 30
+
+The modules under test are imported by the benchmarks themselves, as
+vwap_handler_v2_py2 runs on python 2 and VWAPs on python 3.
+"""
+
+import sys
+import time
+import warnings
+from datetime import datetime
+from datetime import time as dt_time
+import gzip
+import shutil
+from os import listdir
+from os import makedirs
+from os.path import getsize
+from os.path import isdir
+
+import numpy as np
+import pandas as pd
+
+from tick_store import chunk_buckets
+from tick_store import convert_bucket_tree
+from tick_store import convert_tick_tree
+from tick_store import read_tick_chunks
+from tick_store import read_ticks
+
+
+def best_of(func, repeat = 3):
+    """The best wall time of repeat calls of func"""
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def vwap_params(data_path, today, store_path = None, n_hist_day = 15):
+    """The kwargs VWAP_handler would pass to its VWAP objects, with TODAY as a YYYYMMDD string"""
+
+    return {
+        'TODAY': datetime.strptime(today, '%Y%m%d').date(),
+        'T_START_TIME': dt_time(hour = 9, minute = 30, second = 0, microsecond = 0),
+        'T_END_TIME': dt_time(hour = 15, minute = 0, second = 0, microsecond = 0),
+        'LASSO_LAMBDA': 812314,
+        'N_TICK_THRESHOLD': 1000,
+        'DATA_PATH': data_path,
+        'N_HIST_DAY': n_hist_day,
+        'STORE_PATH': store_path
+    }
+
+
+def tick_files(data_path):
+
+    dates = sorted(d for d in listdir(data_path) if isdir(data_path + d))
+    return [(d, f[:-4]) for d in dates for f in sorted(listdir(data_path + d)) if f.endswith('.csv')]
+
+
+def bench_tick_store(data_path, store_path, today, interval = 30):
+    """csv against binary store: raw file reads and full VWAP initialization"""
+
+    import vwap_handler_v2_py2 as v2
+
+    start = time.time()
+    n_converted = convert_tick_tree(data_path, store_path)
+    print('converted %d files in %.3fs' % (n_converted, time.time() - start))
+
+    files = tick_files(data_path)
+    t_csv = best_of(lambda: [read_ticks(data_path, d, t) for d, t in files])
+    t_npz = best_of(lambda: [read_ticks(data_path, d, t, store_path) for d, t in files])
+    print('read %d files: csv %.3fs, npz %.3fs, speedup %.1fx' % (len(files), t_csv, t_npz, t_csv / t_npz))
+
+    tickers = sorted(set(t for _, t in files))
+    csv_params = vwap_params(data_path, today)
+    npz_params = vwap_params(data_path, today, store_path)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        t_csv = best_of(lambda: [v2.VWAP(int(interval), t, csv_params) for t in tickers], repeat = 1)
+        t_npz = best_of(lambda: [v2.VWAP(int(interval), t, npz_params) for t in tickers], repeat = 1)
+    print('init %d VWAP: csv %.3fs, store %.3fs, speedup %.1fx' % (len(tickers), t_csv, t_npz, t_csv / t_npz))
+
+
+def bench_buckets(data_path, store_path, today, intervals = '30,60,300'):
+    """VWAP initialization from ticks against the 5-sec bucket store, at several intervals"""
+
+    import vwap_handler_v2_py2 as v2
+
+    start = time.time()
+    n_converted = convert_bucket_tree(data_path, store_path)
+    print('summarized %d files in %.3fs' % (n_converted, time.time() - start))
+
+    tickers = sorted(set(t for _, t in tick_files(data_path)))
+    tick_params = vwap_params(data_path, today)
+    bucket_params = vwap_params(data_path, today, store_path)
+    for interval in [int(i) for i in intervals.split(',')]:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            t_tick = best_of(lambda: [v2.VWAP(interval, t, tick_params) for t in tickers], repeat = 1)
+            t_bucket = best_of(lambda: [v2.VWAP(interval, t, bucket_params) for t in tickers], repeat = 1)
+        print('init %d VWAP at %ds: ticks %.3fs, buckets %.3fs, speedup %.1fx' % (len(tickers), interval, t_tick, t_bucket, t_tick / t_bucket))
+
+
+def bench_timestamps(ticker_path):
+    """strptime against vectorized parsing of the time column of every file in ticker_path"""
+
+    from tick_store import seconds_from_open
+
+    filenames = sorted(f for f in listdir(ticker_path) if f.endswith('.csv'))
+    h_start_time = datetime(2000, 1, 1, 9, 30)
+    n_tick = 0
+    t_strptime = 0.
+    t_vectorized = 0.
+    for filename in filenames:
+        times = pd.read_csv(ticker_path + filename).iloc[:, 0]
+        n_tick += len(times)
+
+        start = time.time()
+        old = [(datetime.strptime('2000-01-01 ' + dt, "%Y-%m-%d %H:%M:%S") - h_start_time).total_seconds() for dt in times]
+        t_strptime += time.time() - start
+
+        start = time.time()
+        new = seconds_from_open(times)
+        t_vectorized += time.time() - start
+
+        if not np.array_equal(old, new):
+            print('%s: vectorized timestamps differ from strptime' % filename)
+
+    n_file = max(len(filenames), 1)
+    print('%d files, %d ticks: strptime %.4fs/file, vectorized %.4fs/file, speedup %.1fx'
+          % (len(filenames), n_tick, t_strptime / n_file, t_vectorized / n_file, t_strptime / t_vectorized))
+
+
+def bench_batch_history(data_path, today, interval = 30):
+    """Per-ticker history walks against the date-major batch loader of VWAP_handler"""
+
+    import vwap_handler_v2_py2 as v2
+
+    tickers = sorted(set(t for _, t in tick_files(data_path)))
+    params = vwap_params(data_path, today)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        t_ticker = best_of(lambda: [v2.VWAP(int(interval), t, params) for t in tickers], repeat = 1)
+        t_load = best_of(lambda: v2.load_histories(int(interval), tickers, params), repeat = 1)
+        histories = v2.load_histories(int(interval), tickers, params)
+        t_fit = best_of(lambda: [v2.VWAP(int(interval), t, params, histories[t]) for t in tickers], repeat = 1)
+    print('init %d VWAP: per ticker %.3fs, batch load %.3fs + fit %.3fs' % (len(tickers), t_ticker, t_load, t_fit))
+
+
+def bench_pool(data_path, today, workers = '1,2,4', interval = 30):
+    """Loading and fitting every ticker of data_path serially and across process pools"""
+
+    import vwap_handler_v2_py2 as v2
+
+    tickers = sorted(set(t for _, t in tick_files(data_path)))
+    params = vwap_params(data_path, today)
+    t_serial = None
+    for n_workers in [int(n) for n in workers.split(',')]:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            if n_workers > 1:
+                elapsed = best_of(lambda: v2.fit_in_pool(int(interval), tickers, params, n_workers), repeat = 1)
+            else:
+                elapsed = best_of(lambda: [v2.VWAP(int(interval), t, params, h) for t, h in v2.load_histories(int(interval), tickers, params).items()], repeat = 1)
+        if t_serial is None:
+            t_serial = elapsed
+        print('fit %d tickers with %d workers: %.3fs, speedup %.1fx' % (len(tickers), n_workers, elapsed, t_serial / elapsed))
+
+
+def bench_compressed(data_path, archive_path):
+    """Summarizing every tick file of data_path from plain csv and from gzip and zstd archives of it"""
+
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+        print('zstandard is not installed, zstd is left out')
+
+    files = tick_files(data_path)
+    roots = [('csv', data_path, '.csv')]
+    for name, suffix in [('gzip', '.csv.gz'), ('zstd', '.csv.zst')]:
+        if name == 'zstd' and zstandard is None:
+            continue
+        root = archive_path + name + '/'
+        for d, t in files:
+            if not isdir(root + d):
+                makedirs(root + d)
+            with open(data_path + d + '/' + t + '.csv', 'rb') as src:
+                if name == 'gzip':
+                    with gzip.open(root + d + '/' + t + suffix, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                else:
+                    with open(root + d + '/' + t + suffix, 'wb') as dst:
+                        zstandard.ZstdCompressor().copy_stream(src, dst)
+        roots.append((name, root, suffix))
+
+    n_csv_byte = sum(getsize(data_path + d + '/' + t + '.csv') for d, t in files)
+    dates = dict((d, datetime.strptime(d, '%Y%m%d').date()) for d, _ in files)
+    for name, root, suffix in roots:
+        n_byte = sum(getsize(root + d + '/' + t + suffix) for d, t in files)
+        elapsed = best_of(lambda: [chunk_buckets(read_tick_chunks(root, d, t), dates[d]) for d, t in files])
+        print('%s: %d files, %.1f MB on disk (%.0f%% of csv), summarized in %.3fs, %.1f MB of csv/s'
+              % (name, len(files), n_byte / 1e6, 100. * n_byte / n_csv_byte, elapsed, n_csv_byte / 1e6 / elapsed))
+
+
+def ar_series(n_ticker, n_interval, seed = 0):
+    """Deseasonalized interval volumes like VWAP fits its AR(1) on, simulated for n_ticker tickers"""
+
+    rng = np.random.RandomState(seed)
+    mean = rng.uniform(1e4, 1e6, n_ticker)
+    phi = rng.uniform(-0.3, 0.9, n_ticker)
+    series = np.zeros((n_ticker, n_interval))
+    series[:, 0] = mean
+    for t in range(1, n_interval):
+        series[:, t] = mean + phi * (series[:, t - 1] - mean) + rng.normal(0, 0.3, n_ticker) * mean
+
+    return series
+
+
+def bench_ar1(n_ticker = 2000, n_interval = 480):
+    """statsmodels ARMA(1,0) fits ticker by ticker against one fit_ar1 call for all tickers"""
+
+    import vwap_handler_v2_py2 as v2
+    from statsmodels.tsa.arima_model import ARMA
+
+    series = ar_series(int(n_ticker), int(n_interval))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        start = time.time()
+        arma = np.array([ARMA(s, order = (1,0)).fit(disp = 0).params for s in series])
+        t_arma = time.time() - start
+    t_fit = best_of(lambda: v2.fit_ar1(series))
+    pars = v2.fit_ar1(series)
+
+    print('AR(1) of %d tickers x %d intervals: ARMA %.3fs, fit_ar1 %.4fs, speedup %.0fx'
+          % (len(series), series.shape[1], t_arma, t_fit, t_arma / t_fit))
+    print('fit_ar1 - ARMA: mean relative difference max %.2e, phi difference max %.2e, median %.2e'
+          % (np.abs(pars[:, 0] / arma[:, 0] - 1).max(), np.abs(pars[:, 1] - arma[:, 1]).max(), np.median(np.abs(pars[:, 1] - arma[:, 1]))))
+
+
+def lasso_samples(n_ticker, n_day = 10, seed = 0):
+    """Daily volume features and volumes like VWAP regresses on, simulated for n_ticker tickers"""
+
+    rng = np.random.RandomState(seed)
+    scale = rng.uniform(1e6, 1e8, n_ticker)[:, None]
+    volumes = scale * rng.lognormal(0, 0.3, (n_ticker, n_day + 1))
+    features = np.empty((n_ticker, n_day + 1, 3))
+    features[:, :, 0] = volumes * rng.uniform(0.005, 0.02, (n_ticker, n_day + 1)) # call auction
+    features[:, :, 1] = scale * rng.lognormal(0, 0.1, (n_ticker, n_day + 1)) # rolling mean
+    features[:, :, 2] = scale * rng.normal(0, 0.05, (n_ticker, n_day + 1)) # rolling linear
+
+    return features, volumes[:, :-1]
+
+
+def bench_lasso(n_ticker = 2000, lasso_lambda = 812314):
+    """sklearn Lasso fits and predictions ticker by ticker against one fit_lasso call for all tickers"""
+
+    import vwap_handler_v2_py2 as v2
+    from sklearn.linear_model import Lasso
+
+    features, volumes = lasso_samples(int(n_ticker))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        start = time.time()
+        sk_V = np.array([Lasso(alpha = lasso_lambda).fit(f[:-1], v).predict(f[-1:])[0] for f, v in zip(features, volumes)])
+        t_sklearn = time.time() - start
+
+    def batch():
+        w, b = v2.fit_lasso(features[:, :-1], volumes, lasso_lambda)
+        return np.einsum('tj,tj->t', features[:, -1], w) + b
+    t_batch = best_of(batch)
+    V = batch()
+
+    print('Lasso of %d tickers: sklearn %.3fs, fit_lasso %.4fs, speedup %.0fx'
+          % (len(features), t_sklearn, t_batch, t_sklearn / t_batch))
+    print('fit_lasso - sklearn: predicted volume relative difference max %.2e, median %.2e'
+          % (np.abs(V / sk_V - 1).max(), np.median(np.abs(V / sk_V - 1))))
+
+
+def bench_first_tick(data_path, today, interval = 30, lasso_lambda = 812314):
+    """Latency of the first tick after the open: a Lasso fit at the tick against the one fitted at construction"""
+
+    import copy
+    import vwap_handler_v2_py2 as v2
+    from sklearn.linear_model import Lasso
+
+    tickers = sorted(set(t for _, t in tick_files(data_path)))
+    params = vwap_params(data_path, today)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        histories = v2.load_histories(int(interval), tickers, params)
+        vwaps = [v2.VWAP(int(interval), t, params, histories[t]) for t in tickers]
+    vwaps = [vwap for vwap in vwaps if vwap._is_VWAP == 1]
+
+    def sklearn_pred_V(vwap):
+        lm = Lasso(alpha = lasso_lambda).fit(vwap._features_to_train[0:-1,:], vwap.volume_to_train)
+        vwap._set_predicted_V(lm.predict(vwap._today_features().reshape(1,-1))[0])
+
+    def first_ticks(setup):
+        latencies = []
+        for vwap in copy.deepcopy(vwaps):
+            setup(vwap)
+            vwap.push_tick((vwap.T_START_SEC - 60) * 1e9, 100000) # call auction
+            start = time.time()
+            vwap.push_tick((vwap.T_START_SEC + 1) * 1e9, 101000)
+            latencies.append(time.time() - start)
+        return np.array(latencies) * 1e6
+
+    def at_tick(vwap):
+        vwap.pred_V = lambda: sklearn_pred_V(vwap)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name, setup in [('sklearn fit at the tick', at_tick), ('fitted at construction', lambda vwap: None)]:
+            latencies = first_ticks(setup)
+            print('%s: first tick of %d tickers, mean %.1fus, max %.1fus, total %.2fms'
+                  % (name, len(latencies), latencies.mean(), latencies.max(), latencies.sum() / 1e3))
+
+
+def bench_rolling(n_ticker = 2000, n_day = 15, n = 5):
+    """The rolling daily volume features of every ticker by the loop helpers against one vectorized call"""
+
+    import vwap_handler_py2 as v1
+    import vwap_handler_v2_py2 as v2
+
+    n = int(n)
+    volume_sums = np.random.RandomState(0).lognormal(18, 0.4, (int(n_ticker), int(n_day)))
+    start = time.time()
+    loop = np.array([[v1.rolling_mean(a, n), v1.rolling_linear(a, n)] for a in volume_sums])
+    t_loop = time.time() - start
+    t_vectorized = best_of(lambda: (v2.rolling_mean(volume_sums, n), v2.rolling_linear(volume_sums, n)))
+    vectorized = np.array([v2.rolling_mean(volume_sums, n), v2.rolling_linear(volume_sums, n)]).transpose(1, 0, 2)
+
+    print('rolling features of %d tickers x %d days: loops %.3fs, vectorized %.5fs, speedup %.0fx'
+          % (len(volume_sums), volume_sums.shape[1], t_loop, t_vectorized, t_loop / t_vectorized))
+    print('vectorized - loops: relative difference max %.2e' % np.abs(vectorized / loop - 1).max())
+
+
+def bench_replay(data_path, today, intervals = '5,30,300'):
+    """Replaying today's tick files row by row with push_tick against push_ticks on the arrays"""
+
+    import copy
+    import vwap_handler_v2_py2 as v2
+
+    tickers = sorted(t for d, t in tick_files(data_path) if d == today)
+    params = vwap_params(data_path, today)
+    days = [read_ticks(data_path, today, t) for t in tickers]
+    for interval in [int(i) for i in intervals.split(',')]:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            vwaps = [v2.VWAP(interval, t, params) for t in tickers]
+
+            def rows(vwaps):
+                for vwap, dat in zip(vwaps, days):
+                    for row in dat.values.tolist():
+                        vwap.push_tick(row[0], row[1])
+
+            def arrays(vwaps):
+                for vwap, dat in zip(vwaps, days):
+                    vwap.push_ticks(dat['Nano'].values, dat['Volume'].values)
+
+            def replay(push):
+                copies = [copy.deepcopy(vwaps) for _ in range(3)] # fresh objects for every run, copied untimed
+                return best_of(lambda: push(copies.pop()))
+
+            t_rows = replay(rows)
+            t_arrays = replay(arrays)
+        print('replay %d ticks of %d tickers at %ds: push_tick %.3fs, push_ticks %.3fs, speedup %.1fx'
+              % (sum(len(dat) for dat in days), len(tickers), interval, t_rows, t_arrays, t_rows / t_arrays))
+
+
+def bench_book(data_path, today, n_ticker = 4000, snapshot_secs = 3, interval = 30):
+    """A full-market snapshot feed, one tick per ticker every snapshot_secs, into VWAP objects and a VWAPBook"""
+
+    import copy
+    import vwap_handler_v2_py2 as v2
+
+    tickers = sorted(set(t for _, t in tick_files(data_path)))
+    params = vwap_params(data_path, today)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        histories = v2.load_histories(int(interval), tickers, params)
+        fitted = [v2.VWAP(int(interval), t, params, histories[t])._get_fitted() for t in tickers]
+        # the fitted tickers of data_path stand for the whole market
+        vwaps = dict(('T%05d' % i, v2.VWAP(int(interval), 'T%05d' % i, params, fitted = copy.deepcopy(fitted[i % len(fitted)])))
+                     for i in range(int(n_ticker)))
+    book = v2.VWAPBook(copy.deepcopy(vwaps))
+    names = book.tickers
+
+    T_START_SEC = vwaps[names[0]].T_START_SEC
+    secs = np.append(np.arange(-300, 7200, int(snapshot_secs)), np.arange(12600, 19800, int(snapshot_secs)))
+    rng = np.random.RandomState(0)
+    cum_volumes = np.cumsum(rng.poisson(1000, (len(secs), len(names))), axis = 0)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        indices = np.arange(len(names))
+        start = time.time()
+        for sec, cum in zip(secs.tolist(), cum_volumes):
+            book.push_ticks(indices, np.full(len(names), int((T_START_SEC + sec) * 1e9)), cum)
+            book.get_predict(indices, int((T_START_SEC + sec + int(interval)) * 1e9))
+        t_book = time.time() - start
+
+        n_snapshot = len(secs) // 10 # the objects take a tenth of the day
+        start = time.time()
+        for sec, cum in zip(secs[:n_snapshot].tolist(), cum_volumes[:n_snapshot].tolist()):
+            nano = int((T_START_SEC + sec) * 1e9)
+            for name, c in zip(names, cum):
+                vwaps[name].push_tick(nano, c)
+                vwaps[name].get_predict(nano + int(interval) * 10 ** 9)
+        t_objects = (time.time() - start) * len(secs) / n_snapshot
+
+    n_tick = len(secs) * len(names)
+    print('%d snapshots of %d tickers, %d ticks with a prediction each: objects %.1fs (from a tenth of the day), book %.1fs, '
+          '%.0f ticks/s, speedup %.1fx' % (len(secs), len(names), n_tick, t_objects, t_book, n_tick / t_book, t_objects / t_book))
+
+
+def bench_bucket(n_tick = 1000000, interval = 30):
+    """The interval of each tick from float secs and afternoon arithmetic, as push_tick did, against the session map one by one and in a batch"""
+
+    import vwap_handler_v2_py2 as v2
+    from tick_store import SESSIONS
+    from tick_store import session_map
+
+    interval = int(interval)
+    am_n_interval = 7200 // interval
+    T_START_SEC = time.mktime(datetime(2017, 7, 13, 9, 30).timetuple())
+    t_start_nano = int(T_START_SEC) * v2.NANO
+    sec_map, sec_list = session_map(interval, SESSIONS)
+    n_interval = int(sec_map[-1]) + 1
+    rng = np.random.RandomState(0)
+    # ticks in the sessions, half of them within a microsecond before an interval boundary where float secs go wrong
+    n_tick = int(n_tick)
+    secs = np.append(np.arange(0, 7200), np.arange(12600, 19800))
+    boundaries = secs[(secs % interval == 0) & (secs != 0) & (secs != 12600)]
+    nanos = np.sort(t_start_nano + np.append(rng.choice(secs, n_tick - n_tick // 2).astype(np.int64) * v2.NANO
+                                             + rng.randint(0, v2.NANO, n_tick - n_tick // 2),
+                                             rng.choice(boundaries, n_tick // 2).astype(np.int64) * v2.NANO
+                                             - rng.randint(1, 1000, n_tick // 2)))
+    nano_list = nanos.tolist()
+
+    def float_secs():
+        iters = []
+        for nano in nano_list:
+            iter = int(int(nano / 1e9 - T_START_SEC) / interval)
+            if iter > am_n_interval:
+                iter -= int(am_n_interval * 3 / 4)
+            iters.append(iter)
+        return iters
+
+    def int_map():
+        iters = []
+        for nano in nano_list:
+            iter = sec_list[(int(nano) - t_start_nano) // v2.NANO]
+            if iter < 0:
+                iter += n_interval
+            iters.append(iter)
+        return iters
+
+    def float_batch():
+        iters = (nanos / 1e9 - T_START_SEC).astype(int) // interval
+        iters[iters > am_n_interval] -= int(am_n_interval * 3 / 4)
+        return iters
+
+    t_float = best_of(float_secs)
+    t_int = best_of(int_map)
+    t_float_batch = best_of(float_batch)
+    t_batch = best_of(lambda: v2.session_iters(nanos, t_start_nano, sec_map))
+
+    print('interval of %d ticks: float secs %.0f ns/tick, session map %.0f ns/tick, float batch %.1f ns/tick, session_iters %.1f ns/tick'
+          % (n_tick, t_float / n_tick * 1e9, t_int / n_tick * 1e9, t_float_batch / n_tick * 1e9, t_batch / n_tick * 1e9))
+    print('ticks put in the wrong interval: float secs %d, float batch %d, session_iters %d'
+          % (np.sum(np.array(float_secs()) != int_map()), np.sum(float_batch() != int_map()),
+             np.sum(v2.session_iters(nanos, t_start_nano, sec_map)[1] != int_map())))
+
+
+BENCHMARKS = {
+    'tick_store': bench_tick_store,
+    'buckets': bench_buckets,
+    'timestamps': bench_timestamps,
+    'batch_history': bench_batch_history,
+    'pool': bench_pool,
+    'compressed': bench_compressed,
+    'ar1': bench_ar1,
+    'lasso': bench_lasso,
+    'first_tick': bench_first_tick,
+    'rolling': bench_rolling,
+    'replay': bench_replay,
+    'book': bench_book,
+    'bucket': bench_bucket,
+}
+
+
+if __name__ == "__main__":
+
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -11,10 +11,12 @@ import scipy.interpolate
 from sklearn.linear_model import Lasso
 from statsmodels.tsa.arima_model import ARMA
 
-from math import ceil
 import warnings
 from os import listdir 
 
+from tick_store import day_sessions
+from tick_store import session_map
+
 def cov(a,b):
 
     a_mean = np.mean(a)
@@ -120,8 +122,9 @@ class VWAP(object):
         # self.DATA_PATH = './data_path/' # Tracey to notice
         self._interval = interval
         self._interval_timedelta = timedelta(seconds = self._interval)
-        self._am_n_interval = int(self.HALFTIME.total_seconds() / self._interval_timedelta.total_seconds())
-        self._n_interval = int(self._am_n_interval + ceil(( ( self.T_END_SECS - 60 * 60 * 3.5) / self._interval)))
+        # the interval of each sec of the day, see tick_store.session_map
+        self._sec_iter = session_map(self._interval, day_sessions(self.T_END_SECS))[1]
+        self._n_interval = self._sec_iter[-1] + 1
         self._features_to_train = np.ones((11,3),dtype=float) # CA, M, L, A
         self._histo_volume = np.full((10, self._n_interval),0, dtype=float)  # historical trading volume        
         self._intraday_percentage = [1. / self._n_interval] * self._n_interval  # notice .sum() =self._n_interval
@@ -349,10 +352,10 @@ class VWAP(object):
             if not self._is_V_predicted:
                 self.pred_V()
 
-            iter = int(sec_time / self._interval)
-
-            if iter > self._am_n_interval: # in the afternoon
-                iter -= int(self._am_n_interval * 3 / 4)
+            if sec_time < self.T_END_SECS: # lunch ticks go to the morning's last interval
+                iter = self._sec_iter[sec_time] % self._n_interval
+            else:
+                iter = self._n_interval
             self._iter = iter
             
             if self._iter < self._n_interval: # time hasn't exceeded market close time
@@ -11,53 +11,301 @@ from datetime import timedelta
 from datetime import date as date
 from datetime import time as dt_time
 
-import scipy.interpolate
-from sklearn.linear_model import Lasso
-from statsmodels.tsa.arima_model import ARMA
 
-from math import ceil
 import warnings
 from os import listdir 
+from os import rename
+from os.path import isfile
+from multiprocessing import Pool
+from threading import Lock
+from threading import Thread
+
+from tick_store import NANO
+from tick_store import SESSION_END_SECS
+from tick_store import check_bucket_sessions
+from tick_store import chunk_buckets
+from tick_store import day_meta
+from tick_store import day_sessions
+from tick_store import file_ticker
+from tick_store import interval_volume
+from tick_store import journal_day
+from tick_store import load_calendar
+from tick_store import TickJournal
+from tick_store import read_buckets
+from tick_store import read_journal
+from tick_store import read_tick_chunks
+from tick_store import save_calendar
+from tick_store import session_map
+from tick_store import sub_calendar
+from tick_store import trading_days
+from tick_store import trading_days_back
+from tick_store import update_calendar
 
 # helper functions
 
 def cov(a,b):
+    """Sample covariance along the last axis, of each row of 2-D arrays"""
 
-    a_mean = np.mean(a)
-    b_mean = np.mean(b)
-    sum = 0
-    for i in range(0,len(a)):
-        sum += (a[i] - a_mean)*(b[i] - b_mean)
-    
-    return sum / (len(a) - 1)
+    a = np.asarray(a, dtype = float)
+    b = np.asarray(b, dtype = float)
+
+    return ((a - a.mean(axis = -1)[..., None]) * (b - b.mean(axis = -1)[..., None])).sum(axis = -1) / (a.shape[-1] - 1)
 
 
 def getL(y):
-    """By linear regression predict the next value"""
+    """By linear regression predict the next value, of each row of a 2-D y"""
 
-    x = np.array(range(0,len(y)))
-    b = cov(x,y) / cov(x,x)
-    a = np.mean(y) - b * np.mean(x)
-    
-    return b * len(y) + a
+    y = np.asarray(y, dtype = float)
+    x = np.arange(y.shape[-1], dtype = float)
+    b = cov(np.broadcast_to(x, y.shape), y) / cov(x, x)
+    a = y.mean(axis = -1) - b * x.mean()
 
+    return b * y.shape[-1] + a
 
-def rolling_mean(a,n = 5):
 
-    x = [0.] * (len(a)-n + 1)
-    for i in range(n,len(a) +  1):
-        x[i - n] = a[i-n:i].mean()
-    
+def _window_sum(a, weights):
+    """sum(weights * window) of every window of len(weights) days along the last axis of a"""
+
+    a = np.asarray(a, dtype = float)
+    n_window = a.shape[-1] - len(weights) + 1
+    x = np.zeros(a.shape[:-1] + (n_window,))
+    for i, w in enumerate(weights):
+        x += w * a[..., i:i + n_window]
+
     return x
 
 
+def rolling_mean(a,n = 5):
+    """Mean of every n days window, along the last axis so a 2-D a is tickers x days"""
+
+    return _window_sum(a, np.full(n, 1. / n))
+
+
 def rolling_linear(a, n = 5):
-    
-    x = [0.] * (len(a)-n + 1)
-    for i in range(n , len(a)+ 1):
-        x[i - n] = getL(a[i-n:i])
-    
-    return x
+    """getL of every n days window, along the last axis so a 2-D a is tickers x days"""
+
+    # getL is linear in the window: mean + slope * (n - mean of x), slope = sum((x - mean of x) * y) / sum((x - mean of x) ** 2)
+    x = np.arange(n, dtype = float) - (n - 1) / 2.
+
+    return _window_sum(a, 1. / n + x * (n + 1) / 2. / (x ** 2).sum())
+
+
+def fit_ar1(series):
+    """
+    AR(1) fits of many series at once, the (mean, phi) ARMA(1,0).fit() gives
+
+    The mean is the sample mean and phi the exact maximum likelihood estimate given it,
+    the root in (-1, 1) of the cubic the concentrated likelihood leads to (Beach and
+    MacKinnon, 1978), so no iteration is needed.
+
+    Args:
+        series: tickers x T array, or a single series
+
+    Returns:
+        tickers x 2 array of (mean, phi), or a single pair
+    """
+
+    series = np.asarray(series, dtype = float)
+    single = series.ndim == 1
+    series = np.atleast_2d(series)
+    T = series.shape[1]
+
+    mean = series.mean(axis = 1)
+    y = series - mean[:, None]
+    A = (y ** 2).sum(axis = 1)
+    B = (y[:, 1:] * y[:, :-1]).sum(axis = 1)
+    C = (y[:, 1:-1] ** 2).sum(axis = 1)
+
+    # (T - 1) C phi^3 - (T - 2) B phi^2 - (T C + A) phi + T B = 0, with its three real roots
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        a2 = -(T - 2) * B / ((T - 1) * C)
+        a1 = -(T * C + A) / ((T - 1) * C)
+        a0 = T * B / ((T - 1) * C)
+        p = a1 - a2 ** 2 / 3
+        q = 2 * a2 ** 3 / 27 - a2 * a1 / 3 + a0
+        theta = np.arccos(np.clip(1.5 * q / p * np.sqrt(-3 / p), -1, 1))
+        roots = np.array([2 * np.sqrt(-p / 3) * np.cos((theta - 2 * np.pi * k) / 3) - a2 / 3 for k in range(3)])
+
+        # the stationary root of highest likelihood
+        roots[~(np.abs(roots) < 1)] = np.nan
+        S = A - 2 * B * roots + C * roots ** 2
+        loglik = -T / 2. * np.log(S) + 0.5 * np.log(1 - roots ** 2)
+    loglik[np.isnan(loglik)] = -np.inf
+    phi = roots[np.argmax(loglik, axis = 0), np.arange(len(mean))]
+    phi[np.all(np.isinf(loglik), axis = 0)] = 0. # constant series
+
+    pars = np.column_stack((mean, phi))
+
+    return pars[0] if single else pars
+
+
+def _lags(y, n_lag, start):
+    """The columns y[t - 1], .., y[t - n_lag] for t from start on"""
+
+    return [y[start - j:len(y) - j] for j in range(1, n_lag + 1)]
+
+
+def fit_arma(series, p = 1, q = 0):
+    """
+    ARMA(p, q) parameters of one series for the state-space intraday model
+
+    AR(1) is fit_ar1's. Otherwise the Hannan-Rissanen regressions are used: a long AR
+    gives the innovations, then the series is regressed on p of its lags and q lagged
+    innovations.
+
+    Returns:
+        array of mean, innovation variance, ar_1 .. ar_p, ma_1 .. ma_q
+    """
+
+    x = np.asarray(series, dtype = float)
+    if (p, q) == (1, 0):
+        mean, phi = fit_ar1(x)
+        e = x[1:] - mean - phi * (x[:-1] - mean)
+        return np.array([mean, e.var(), phi])
+
+    mean = x.mean()
+    y = x - mean
+    if p + q == 0:
+        return np.array([mean, y.var()])
+
+    e = np.zeros(len(y))
+    k = 0
+    if q > 0:
+        k = max(p + q, int(10 * np.log10(len(y))))
+        long_lags = np.column_stack(_lags(y, k, k))
+        e[k:] = y[k:] - long_lags.dot(np.linalg.lstsq(long_lags, y[k:], rcond = None)[0])
+
+    start = k + max(p, q)
+    design = np.column_stack(_lags(y, p, start) + _lags(e, q, start))
+    coef = np.linalg.lstsq(design, y[start:], rcond = None)[0]
+    resid = y[start:] - design.dot(coef)
+
+    return np.concatenate([[mean, resid.var()], coef])
+
+
+def arma_system(pars, p, q):
+    """
+    Transition T and state noise covariance Q of an ARMA(p, q) in state-space form
+
+    The state has m = max(p, q + 1) entries, the first is the series less its mean:
+    state[t] = T state[t - 1] + R e[t], R = (1, ma_1, .., ma_(m-1)).
+    """
+
+    m = max(p, q + 1)
+    T = np.eye(m, k = 1)
+    T[:p, 0] = pars[2:2 + p]
+    R = np.zeros(m)
+    R[0] = 1.
+    R[1:q + 1] = pars[2 + p:2 + p + q]
+
+    return T, pars[1] * np.outer(R, R)
+
+
+def kalman_start(pars, p, q):
+    """The state mean and stationary covariance of an ARMA(p, q) before any observation"""
+
+    T, Q = arma_system(pars, p, q)
+    m = len(T)
+    if np.all(np.abs(np.linalg.eigvals(T)) < 1):
+        P = np.linalg.solve(np.eye(m * m) - np.kron(T, T), Q.ravel()).reshape(m, m)
+    else: # not stationary, start from one step of noise
+        P = Q.copy()
+
+    return np.zeros(m), P
+
+
+def kalman_step(a, P, y, T, Q):
+    """
+    Filter the observed first state entry y in, then predict the next state
+
+    The series is observed without noise, so after the update the first entry is y.
+    Costs O(m^2) whatever the number of steps before.
+
+    Returns:
+        (a, P) of the next step
+    """
+
+    F = P[0, 0]
+    if F > 0:
+        K = P[:, 0] / F
+        a = a + K * (y - a[0])
+        P = P - np.outer(K, P[0])
+    else:
+        a = a.copy()
+        a[0] = y
+
+    return T.dot(a), T.dot(P).dot(T.T) + Q
+
+
+def fit_lasso(X, y, alpha, max_iter = 1000, tol = 1e-10):
+    """
+    Lasso fits of many small regressions at once, what sklearn's Lasso(alpha).fit(X, y) solves
+
+    minimize ||y - X w - b||^2 / (2 n) + alpha ||w||_1 for every ticker, by coordinate
+    descent on the p x p Gram matrices of the centered features, all tickers a step at
+    a time, until no coefficient moves by more than tol relative to the largest one.
+
+    Args:
+        X: tickers x n x p features, or a single n x p
+        y: tickers x n targets, or a single n
+
+    Returns:
+        (w, b): tickers x p coefficients and tickers intercepts, or a single fit
+    """
+
+    X = np.asarray(X, dtype = float)
+    y = np.asarray(y, dtype = float)
+    single = X.ndim == 2
+    if single:
+        X = X[None]
+        y = y[None]
+    n, p = X.shape[1:]
+
+    X_mean = X.mean(axis = 1)
+    y_mean = y.mean(axis = 1)
+    Xc = X - X_mean[:, None, :]
+    yc = y - y_mean[:, None]
+    G = np.einsum('tij,tik->tjk', Xc, Xc) / n
+    c = np.einsum('tij,ti->tj', Xc, yc) / n
+    G_diag = np.einsum('tjj->tj', G)
+    active = G_diag > 0 # a constant feature keeps a zero coefficient
+
+    w = np.zeros((len(X), p))
+    for _ in range(max_iter):
+        w_max = np.zeros(len(X))
+        dw_max = np.zeros(len(X))
+        for j in range(p):
+            rho = c[:, j] - np.einsum('tk,tk->t', G[:, j], w) + G[:, j, j] * w[:, j]
+            w_j = np.where(active[:, j], np.sign(rho) * np.maximum(np.abs(rho) - alpha, 0) / np.where(active[:, j], G[:, j, j], 1), 0)
+            dw_max = np.maximum(dw_max, np.abs(w_j - w[:, j]))
+            w[:, j] = w_j
+            w_max = np.maximum(w_max, np.abs(w_j))
+        if np.all(dw_max <= tol * w_max):
+            break
+
+    b = y_mean - np.einsum('tj,tj->t', X_mean, w)
+
+    return (w[0], b[0]) if single else (w, b)
+
+
+def intraday_pattern(histo_volume):
+    """
+    Intraday volume pattern of history days, mean interval volume over the mean interval's
+
+    Intervals under 0.1 of the mean are raised to 0.1 and the others scaled down
+    to keep the sum at the number of intervals.
+    """
+
+    intraday_mean = histo_volume.mean(axis = 0) # TODO na skip
+    n_interval = len(intraday_mean)
+    tmp = np.divide(intraday_mean, intraday_mean.sum()) * n_interval
+    # print tmp # Tracey to notice
+    if np.any(tmp < 0.1):
+        warnings.warn('adjust intraday trading volume pattern for irregular data')
+        tmp[tmp >= 0.1] = tmp[tmp > 0.1] * (n_interval - 0.1 * len(tmp[tmp < 0.1])) / sum(tmp[tmp >= 0.1])
+        tmp[tmp < 0.1] = 0.1
+
+    return tmp
 
 
 def get_log(r_vol,p_vol,p_per): 
@@ -65,6 +313,37 @@ def get_log(r_vol,p_vol,p_per):
     return {'r_vol':r_vol, 'p_vol':p_vol, 'p_per':p_per}
 
 
+def log_to_array(log, datetime_index):
+    """_VWAP_log as an n_interval x 4 array of (logged, r_vol, p_vol, p_per), nan for None"""
+
+    a = np.zeros((len(datetime_index), 4), dtype = float)
+    for i, dt in enumerate(datetime_index):
+        if dt in log:
+            a[i] = [1] + [np.nan if log[dt][k] is None else log[dt][k] for k in ('r_vol', 'p_vol', 'p_per')]
+
+    return a
+
+
+def log_from_array(a, datetime_index):
+
+    log = {}
+    for i, dt in enumerate(datetime_index):
+        if a[i, 0]:
+            log[dt] = get_log(*[None if np.isnan(x) else x for x in a[i, 1:]])
+
+    return log
+
+
+def next_weekday(day):
+    """The first Monday to Friday after day, the next trading day unless it is a holiday"""
+
+    day += timedelta(days = 1)
+    while day.weekday() >= 5:
+        day += timedelta(days = 1)
+
+    return day
+
+
 def datetime_range(T_START_TIME, T_END_TIME ,delta):
 
     current = datetime.combine(date.today(), T_START_TIME)
@@ -73,12 +352,257 @@ def datetime_range(T_START_TIME, T_END_TIME ,delta):
         yield current
         current += delta
 
+def trading_sessions(kwargs):
+    """
+    (T_END_SECS, sessions) of the VWAP kwargs in secs from T_START_TIME
+
+    SESSIONS, a list of (open, close) times, defaults to the exchange's, see
+    tick_store.day_sessions for how T_END_TIME cuts them. Sessions the history buckets
+    do not cover raise ValueError, see tick_store.check_bucket_sessions.
+    """
+
+    today = kwargs['TODAY']
+
+    def secs(t):
+        return int((datetime.combine(today, t) - datetime.combine(today, kwargs['T_START_TIME'])).total_seconds())
+
+    t_end_secs = secs(kwargs['T_END_TIME'])
+    sessions = kwargs.get('SESSIONS')
+    sessions = day_sessions(t_end_secs, None if sessions is None else [(secs(a), secs(b)) for a, b in sessions])
+    check_bucket_sessions(sessions)
+
+    return t_end_secs, sessions
+
+
+def session_iters(nanos, t_start_nano, sec_iter):
+    """
+    Secs from the opening and session_map interval of each of a batch of epoch nanos
+
+    The secs are found in int64 floor division, so the bucket of a tick does not depend
+    on float rounding. Secs before the opening or after the close get the map at its ends.
+
+    Returns:
+        (sec_time, iters), iters negative in the breaks as in the map
+    """
+
+    sec_time = (np.asarray(nanos, dtype = np.int64) - t_start_nano) // NANO
+
+    return sec_time, sec_iter[np.clip(sec_time, 0, len(sec_iter) - 1)]
+
+
+def read_history_day(ticker, histo_date, data_path, store_path = None, t_end_secs = SESSION_END_SECS, meta = None, need_volume = True):
+    """
+    n_tick, CA volume, session total and 5-sec bucket volumes of a history day, None if unusable
+
+    With the calendar's file_meta of the day no file is read when the bucket volumes are
+    not needed or the day has no call auction, meta (without 'volume') is returned.
+    """
+
+    if meta is not None and t_end_secs == SESSION_END_SECS and (not need_volume or meta['ca'] < 1):
+        return meta
+
+    histo_date_str = histo_date.strftime("%Y%m%d")
+    if store_path is not None and t_end_secs == SESSION_END_SECS:
+        day = read_buckets(store_path, histo_date_str, ticker)
+        if day is not None:
+            return day
+
+    try:
+        chunks = read_tick_chunks(data_path, histo_date_str, ticker, store_path)
+    except Exception:
+        print 'Error in reading %s for %s, go to the previous day.' % (ticker + '.csv', str(histo_date))
+        return None
+
+    try:
+        return chunk_buckets(chunks, histo_date, t_end_secs)
+    except Exception:
+        print 'Error when read %s at %s, you may check its format' % (ticker, histo_date_str)
+        return None
+
+
+def history_day_files(tickers, kwargs, pending):
+    """
+    (histo_date_str, indices of tickers) of the history days of the pending tickers, newest first
+
+    With a trading calendar in kwargs the days come from it, merged across the tickers,
+    and files with few ticks are left out; otherwise the date directories under
+    DATA_PATH are listed. pending is read as the days are consumed.
+    """
+
+    today_str = kwargs['TODAY'].strftime("%Y%m%d")
+    calendar = kwargs.get('CALENDAR')
+
+    if calendar is None:
+        index = dict((ticker, i) for i, ticker in enumerate(tickers))
+        for histo_date_str in sorted(listdir(kwargs['DATA_PATH']), reverse = True):
+            if not pending:
+                return
+            if histo_date_str >= today_str:
+                continue
+            try:
+                files = listdir(kwargs['DATA_PATH'] + histo_date_str)
+            except OSError:
+                continue
+            found = set(index[t] for t in map(file_ticker, files) if t in index)
+            yield histo_date_str, sorted(found & pending)
+        return
+
+    days = dict((i, trading_days(calendar, tickers[i], today_str, kwargs['N_TICK_THRESHOLD'])) for i in pending)
+    heads = {}
+    def advance(i):
+        histo_date_str = next(days[i], None)
+        if histo_date_str is not None:
+            heads.setdefault(histo_date_str, []).append(i)
+
+    for i in days:
+        advance(i)
+    while heads:
+        histo_date_str = max(heads)
+        indices = heads.pop(histo_date_str)
+        yield histo_date_str, indices
+        for i in indices:
+            if i in pending:
+                advance(i)
+
+
+def load_histories(interval, tickers, kwargs):
+    """
+    Date-major history loading for many tickers
+
+    The history days are walked back from TODAY (see history_day_files) and the
+    files of all the tickers still short of history are read in each day's pass.
+    A ticker takes its days as a VWAP loading alone does: N4REGRESS days with
+    enough ticks and some call auction volume, then N4ROLLING older days with
+    enough ticks.
+
+    The intraday pattern and the AR(1) of the tickers with a complete history are
+    fitted here, the AR(1) of all of them in one fit_ar1 call.
+
+    Returns:
+        a dict of ticker to its history (see VWAP._fit_history), whose arrays are
+        slices of one tickers x days (x intervals) array per field
+    """
+
+    n4rolling = int(kwargs['N_HIST_DAY'] / 3)
+    n4regress = kwargs['N_HIST_DAY'] - n4rolling
+    today = kwargs['TODAY']
+    t_end_secs, sessions = trading_sessions(kwargs)
+    n_interval = int(session_map(interval, sessions)[0][-1]) + 1
+    calendar = kwargs.get('CALENDAR')
+
+    ca = np.zeros((len(tickers), n4regress), dtype = float)
+    histo_volume = np.zeros((len(tickers), n4regress, n_interval), dtype = float)
+    volume_sums = np.zeros((len(tickers), n4rolling), dtype = float)
+    n_day = np.zeros(len(tickers), dtype = int)
+    pending = set(range(len(tickers)))
+
+    for histo_date_str, indices in history_day_files(tickers, kwargs, pending):
+
+        try:
+            histo_date = datetime.strptime(histo_date_str, "%Y%m%d").date()
+        except ValueError:
+            continue
+        if calendar is None:
+            past_days = today.toordinal() - histo_date.toordinal()
+        else:
+            past_days = trading_days_back(calendar, histo_date_str, today.strftime("%Y%m%d"))
+
+        for i in indices:
+
+            meta = None if calendar is None else day_meta(calendar, tickers[i], histo_date_str)
+            day = read_history_day(tickers[i], histo_date, kwargs['DATA_PATH'], kwargs.get('STORE_PATH'), t_end_secs,
+                                   meta, need_volume = n_day[i] < n4regress)
+            if day is None:
+                continue
+
+            if day['n_tick'] < kwargs['N_TICK_THRESHOLD']:
+                print '%s in %s has few data for prediction' % (tickers[i] + '.csv', str(histo_date))
+                continue
+
+            if n_day[i] < n4regress:
+                if past_days > 2 * n4regress:
+                    warnings.warn('Lack historical data. Time span of data for predicting intraday_volume of today has exceeded 2 times the desired days.'
+                                    'We are using data %d days from today' % past_days) 
+
+                if day['ca'] < 1: # no data or no trade ?
+                    continue
+
+                ca[i, n4regress - 1 - n_day[i]] = day['ca']
+                histo_volume[i, n4regress - 1 - n_day[i]] = interval_volume(day['volume'], interval, sessions)
+            else:
+                if past_days > 3 * n4regress:
+                    warnings.warn('Lack efficacious historical data. Time span of data for predicting total trading volume of today has exceeded 3 times the desired days.')
+
+                volume_sums[i, n4regress + n4rolling - 1 - n_day[i]] = day['total']
+
+            n_day[i] += 1
+            if n_day[i] == n4regress + n4rolling:
+                pending.discard(i)
+
+    histories = dict((ticker, {'ca': ca[i], 'histo_volume': histo_volume[i], 'volume_sums': volume_sums[i], 'n_day': n_day[i]})
+                     for i, ticker in enumerate(tickers))
+
+    complete = [i for i in range(len(tickers)) if n_day[i] == n4regress + n4rolling]
+    if complete:
+        patterns = np.array([intraday_pattern(histo_volume[i]) for i in complete])
+        ar_pars = fit_ar1(histo_volume[complete, -1] / patterns)
+        for j, i in enumerate(complete):
+            histories[tickers[i]]['pattern'] = patterns[j]
+            histories[tickers[i]]['ar_pars'] = ar_pars[j]
+
+    return histories
+
+def _fit_chunk(args):
+    """Pool worker: load and fit a chunk of tickers, return their fitted states"""
+
+    interval, tickers, kwargs = args
+    histories = load_histories(interval, tickers, kwargs)
+
+    return [(ticker, VWAP(interval, ticker, kwargs, histories[ticker])._get_fitted()) for ticker in tickers]
+
+
+def fit_in_pool(interval, tickers, kwargs, n_workers):
+    """
+    Load and fit tickers across a pool of n_workers processes
+
+    Tickers are dealt into a few chunks per worker, each chunk is loaded date-major
+    and fitted in one worker, and only the fitted arrays are sent back. A chunk
+    takes only its tickers' part of the calendar. A chunk whose worker fails falls
+    back to TWAP.
+
+    Returns:
+        a dict of ticker to its fitted state, see VWAP._get_fitted
+    """
+
+    n_chunk = min(len(tickers), 4 * n_workers)
+    chunks = [tickers[i::n_chunk] for i in range(n_chunk)]
+    calendar = kwargs.get('CALENDAR')
+    fitted = {}
+
+    pool = Pool(n_workers)
+    try:
+        results = [pool.apply_async(_fit_chunk, ((interval, chunk, kwargs if calendar is None
+                                                  else dict(kwargs, CALENDAR = sub_calendar(calendar, chunk))),))
+                   for chunk in chunks]
+        for chunk, result in zip(chunks, results):
+            try:
+                fitted.update(result.get())
+            except Exception:
+                print 'Error to initialize %s in a worker, using TWAP' % ', '.join(chunk)
+                for ticker in chunk:
+                    fitted[ticker] = {'_is_VWAP': 0}
+    finally:
+        pool.close()
+        pool.join()
+
+    return fitted
+
 class VWAP_handler(object):
     """
     a single VWAP object will track and predict one ticker
     """
 
-    def __init__(self, interval, tickers, data_path ,lasso_lambda = 812314, n_tick_threshold = 1000, market_close_time = '15:00:00', n_hist_day = 15):
+    def __init__(self, interval, tickers, data_path ,lasso_lambda = 812314, n_tick_threshold = 1000, market_close_time = '15:00:00', n_hist_day = 15, store_path = None, n_workers = 1, state_path = None, journal_path = None, lazy = False, intraday_arma = None, sessions = None):
 
         self.tickers = {}
         self._params = {
@@ -89,229 +613,718 @@ class VWAP_handler(object):
             'LASSO_LAMBDA': lasso_lambda,
             'N_TICK_THRESHOLD': n_tick_threshold, # Tracey to notice
             'DATA_PATH': data_path,
-            'N_HIST_DAY' : n_hist_day
+            'N_HIST_DAY' : n_hist_day,
+            'STORE_PATH': store_path,
+            'CALENDAR': None,
+            'INTRADAY_ARMA': intraday_arma,
+            # (open, close) of each trading session, the exchange's by default, cut at market_close_time
+            'SESSIONS': None if sessions is None else [tuple(datetime.strptime(t, '%H:%M:%S').time() for t in session)
+                                                       for session in sessions]
         }
 
-        for ticker in tickers:
-            self.tickers[ticker] = VWAP(interval, ticker, self._params)
-        
+        self._interval = interval
+        self._n_workers = n_workers
+        self._journal = None
+        self._journal_path = journal_path
+        self._journal_since = {} # journal records already in the state of restored tickers
+        self._lazy = set() # registered, built on first touch
+        self._warming = {} # being built in the background, to the ticks pushed meanwhile
+        self._lock = Lock()
+        self._update_calendar()
+
+        if state_path is not None and isfile(state_path): # restart, only the tickers not saved today are built
+            try:
+                self.load_state(state_path)
+            except Exception:
+                print 'Error to load state %s, building all tickers' % state_path
+                self.tickers = {}
+                self._journal_since = {}
+        tickers = [ticker for ticker in tickers if ticker not in self.tickers]
+
+        if lazy: # one shared TWAP object stands for all the tickers not built yet
+            self._twap = VWAP(interval, 'TWAP', self._params, fitted = {})
+            for ticker in tickers:
+                self.tickers[ticker] = self._twap
+            self._lazy.update(tickers)
+        else:
+            self.tickers.update(self._build(tickers))
+
+        if journal_path is not None: # one journal a day, replayed on restart and appended to
+            if isfile(journal_path):
+                day = journal_day(journal_path)
+                if day == self._params['TODAY']:
+                    self.replay_journal(journal_path, self._journal_since)
+                else:
+                    print 'Journal %s is not for today, moved aside' % journal_path
+                    self._rotate_journal(day)
+            self._journal = TickJournal(journal_path, day = self._params['TODAY'])
+
+    def _build(self, tickers):
+        """
+        Load and fit tickers, across a process pool if the handler has workers
+
+        A single ticker, e.g. a lazy one on its first tick, is built in this process:
+        starting a pool would cost more than the fit itself.
+        """
+
+        vwaps = {}
+        if self._n_workers > 1 and len(tickers) > 1: # build tickers across a process pool
+            fitted = fit_in_pool(self._interval, list(tickers), self._params, self._n_workers)
+            for ticker in tickers:
+                vwaps[ticker] = VWAP(self._interval, ticker, self._params, fitted = fitted[ticker])
+        else:
+            histories = load_histories(self._interval, tickers, self._params)
+            for ticker in tickers:
+                vwaps[ticker] = VWAP(self._interval, ticker, self._params, histories[ticker])
+
+        return vwaps
+
+    def _touch(self, tickers):
+        """Build the lazily registered ones of tickers now"""
+
+        with self._lock:
+            tickers = [ticker for ticker in tickers if ticker in self._lazy]
+            self._lazy.difference_update(tickers)
+        if tickers:
+            self.tickers.update(self._build(tickers))
+
+    def prewarm(self, tickers):
+        """
+        Build lazily registered tickers in a background thread
+
+        They keep serving TWAP until built; ticks pushed to them meanwhile are held and
+        pushed to the built VWAP before it replaces the TWAP one.
+
+        Returns:
+            the started thread
+        """
+
+        with self._lock:
+            tickers = [ticker for ticker in tickers if ticker in self._lazy]
+            self._lazy.difference_update(tickers)
+            for ticker in tickers:
+                self._warming[ticker] = []
+
+        thread = Thread(target = self._warm, args = (tickers,))
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    def _warm(self, tickers):
+
+        try:
+            vwaps = self._build(tickers)
+        except Exception:
+            print 'Error to prewarm %s, using TWAP' % ', '.join(tickers)
+            vwaps = dict((ticker, VWAP(self._interval, ticker, self._params, fitted = {})) for ticker in tickers)
+
+        with self._lock:
+            for ticker, vwap in vwaps.items():
+                ticks = self._warming.pop(ticker)
+                if ticks:
+                    vwap.push_ticks([t[0] for t in ticks], [t[1] for t in ticks])
+                self.tickers[ticker] = vwap
+
+    def push_tick(self, ticker, nano, cum_volume):
+
+        if self._journal is not None:
+            self._journal.append(ticker, nano, cum_volume)
+
+        if ticker in self._lazy:
+            self._touch([ticker])
+        if ticker in self._warming:
+            with self._lock:
+                if ticker in self._warming:
+                    self._warming[ticker].append((nano, cum_volume))
+                    return
+
+        self.tickers[ticker].push_tick(nano, cum_volume)
+
+    def get_predict(self, ticker, nano):
+
+        if ticker in self._lazy:
+            self._touch([ticker])
+
+        return self.tickers[ticker].get_predict(nano)
+
+    def predict_volumes(self):
+        """
+        Predict today's volume of every built ticker at once
+
+        Meant for the end of the call auction, so that the first ticks of the session
+        don't even take pred_V's dot product. Tickers predicted already are left as they are.
+
+        Returns:
+            a dict of ticker: predicted volume
+        """
+
+        with self._lock:
+            vwaps = [(ticker, vwap) for ticker, vwap in sorted(self.tickers.items())
+                     if ticker not in self._lazy and vwap._is_VWAP == 1 and not vwap._is_V_predicted]
+        if not vwaps:
+            return {}
+
+        for _, vwap in vwaps:
+            if not hasattr(vwap, '_lasso_coef'): # restored from a state saved without it
+                vwap._fit_lasso()
+        features = np.array([vwap._today_features() for _, vwap in vwaps])
+        coefs = np.array([vwap._lasso_coef for _, vwap in vwaps])
+        for (_, vwap), V in zip(vwaps, np.einsum('tj,tj->t', features, coefs[:, :-1]) + coefs[:, -1]):
+            vwap._set_predicted_V(V)
+
+        return dict((ticker, vwap._predicted_V) for ticker, vwap in vwaps)
+
+    def close(self):
+        """Flush and close the tick journal"""
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _rotate_journal(self, day):
+        """Move the journal file aside to journal_path.YYYYMMDD of day, .old if it has no day"""
+
+        rename(self._journal_path, self._journal_path + '.' + ('old' if day is None else day.strftime('%Y%m%d')))
+
+    def replay_journal(self, file_path, since = None):
+        """
+        Push the ticks of a tick journal again, e.g. to rebuild the day after a restart
+
+        Records are grouped by ticker with one stable sort and each ticker takes its
+        ticks in one VWAP.push_ticks call.
+
+        Args:
+            since: ticker to the index of the first record to replay, 0 for those not in it
+
+        Returns:
+            the number of records in the journal
+        """
+
+        if since is None:
+            since = {}
+
+        records = read_journal(file_path)
+        order = np.argsort(records['ticker'], kind = 'mergesort')
+        names, first = np.unique(records['ticker'][order], return_index = True)
+        bounds = np.append(first, len(order))
+        self._touch([str(name.decode('ascii')) for name in names])
+
+        for j, name in enumerate(names):
+            ticker = str(name.decode('ascii'))
+            if ticker not in self.tickers:
+                continue
+            rows = order[bounds[j]:bounds[j + 1]]
+            rows = rows[rows >= since.get(ticker, 0)]
+            self.tickers[ticker].push_ticks(records['nano'][rows], records['cum_volume'][rows])
+
+        return len(records)
+
+    def _update_calendar(self):
+        """Load and extend the trading calendar kept next to the store, up to TODAY"""
+
+        store_path = self._params['STORE_PATH']
+        if store_path is None:
+            return
+
+        calendar = load_calendar(store_path)
+        if update_calendar(self._params['DATA_PATH'], calendar, before = self._params['TODAY'].strftime("%Y%m%d")):
+            save_calendar(store_path, calendar)
+        self._params['CALENDAR'] = calendar
+
+    def save_state(self, file_path):
+        """Write the fitted and intraday state of every ticker to one binary file, see VWAP.save_state"""
+
+        state = {}
+        for ticker, vwap in self.tickers.items():
+            if ticker in self._lazy or ticker in self._warming:
+                continue
+            for name, value in vwap._get_state().items():
+                state[ticker + '/' + name] = value
+        if self._journal is not None: # the journal records this state already holds
+            self._journal.flush()
+            state['journal_records'] = np.array(self._journal.n_record)
+
+        with open(file_path + '.tmp', 'wb') as f:
+            np.savez(f, **state)
+        rename(file_path + '.tmp', file_path)
+
+    def load_state(self, file_path):
+        """
+        Restore the tickers saved by save_state today, with no history reading or fitting
+
+        Returns:
+            the tickers restored
+        """
+
+        states = {}
+        n_journaled = 0
+        data = np.load(file_path)
+        try:
+            for key in data.files:
+                if key == 'journal_records':
+                    n_journaled = int(data[key])
+                    continue
+                ticker, name = key.split('/', 1)
+                states.setdefault(ticker, {})[name] = data[key]
+        finally:
+            data.close()
+
+        restored = []
+        for ticker, state in states.items():
+            if int(state['TODAY']) != self._params['TODAY'].toordinal():
+                print 'State of %s in %s is not for today, ignored' % (ticker, file_path)
+                continue
+            vwap = VWAP(self._interval, ticker, self._params, fitted = {}) # bare, the state fills it
+            try:
+                vwap._set_state(state)
+            except ValueError as e:
+                print 'State of %s in %s ignored, %s' % (ticker, file_path, e)
+                continue
+            self.tickers[ticker] = vwap
+            self._lazy.discard(ticker)
+            self._journal_since[ticker] = n_journaled
+            restored.append(ticker)
+
+        return restored
+
+    def roll_day(self, next_day = None):
+        """
+        End of day: move every ticker on to next_day (default the next weekday after TODAY,
+        pass it explicitly before a holiday)
+
+        Tickers roll their history window forward with today's ticks (see VWAP.roll_day),
+        those that can not are rebuilt from the history files, which must include today's.
+        Today's journal is moved aside and a new one started for next_day.
+        """
+
+        if next_day is None:
+            next_day = next_weekday(self._params['TODAY'])
+        if self._journal is not None:
+            self._journal.close()
+            self._rotate_journal(self._params['TODAY'])
+            self._journal = TickJournal(self._journal_path, day = next_day)
+        self._journal_since = {}
+        self._params['TODAY'] = next_day
+
+        if self._lazy:
+            self._twap._start_day(next_day)
+
+        stale = [ticker for ticker, vwap in self.tickers.items()
+                 if ticker not in self._lazy and ticker not in self._warming and not vwap.roll_day(next_day)]
+        if stale:
+            self._update_calendar()
+            self.tickers.update(self._build(stale))
+
 class VWAP(object):
     """
     a single VWAP object will track and predict one ticker
     """
-    HALFTIME = timedelta(hours = 2)
-
-    def __init__(self, interval, ticker, kwargs):
+    # what _fit_history produces, enough to rebuild a fitted VWAP without its history
+    FITTED_ATTRS = ('_features_to_train', 'volume_to_train', '_volume_sums', '_lasso_coef', '_histo_volume', '_intraday_percentage',
+                    '_AR_pars', '_ARMA_pars', '_ARMA_order', '_p_per', '_p_vol', '_VWAP_log', '_is_VWAP')
+    # with FITTED_ATTRS, what save_state keeps of the day so far
+    INTRADAY_ATTRS = ('_CA_today', '_predicted_V', '_is_V_predicted', '_last_update', '_iter', '_today_vol', '_cum_vol',
+                      '_n_tick', '_p_per_scale', '_state_mean', '_state_cov')
+    LIST_ATTRS = set(['_intraday_percentage', '_AR_pars', '_p_per', '_p_vol', '_today_vol'])
+
+    def __init__(self, interval, ticker, kwargs, history = None, fitted = None):
         
-        if (interval % 5 != 0) or (7200 % interval != 0):
-            raise ValueError('interval must be a multiple of 5 secs and can divide 2 hours')
+        if interval % 5 != 0:
+            raise ValueError('interval must be a multiple of 5 secs')
 
         # ugly!
         # tickercsv = ticker + '.csv'
         # if not tickercsv in listdir(kwargs['DATA_PATH'] + (kwargs['TODAY'] - timedelta(days = 1)).strftime('%Y%m%d') ):
             # raise Exception('no data for %s' % ticker)
 
-        dates = set(listdir(kwargs['DATA_PATH']))
-
+        self.ticker = ticker
         self.TODAY = kwargs['TODAY']
         # self.TODAY = datetime.strptime(today_for_test, "%Y-%m-%d")  # Tracey to notice
         self.T_START_TIME = kwargs['T_START_TIME']
-        self.T_START_SEC = time.mktime(datetime.combine(self.TODAY, dt_time(hour = 9, minute = 30, second = 0, microsecond = 0) ).timetuple())
         # self.T_START_TIME = self.TODAY.replace(hour = 9, minute = 30, second = 0, microsecond = 0)
         self.T_END_TIME = kwargs['T_END_TIME']
-        self.T_END_SECS = int((datetime.combine(self.TODAY,self.T_END_TIME) - datetime.combine(self.TODAY, self.T_START_TIME)).total_seconds())
+        self.T_END_SECS, self.SESSIONS = trading_sessions(kwargs)
         # self.T_END_TIME = self.TODAY.replace(hour = 15, minute = 00, second = 0, microsecond = 0)
         self.LASSO_LAMBDA = kwargs['LASSO_LAMBDA']
         self.N_TICK_THRESHOLD = kwargs['N_TICK_THRESHOLD'] # Tracey to notice
         self.DATA_PATH = kwargs['DATA_PATH']
+        self.STORE_PATH = kwargs.get('STORE_PATH') # binary tick store, csv files are the fallback
+        self.CALENDAR = kwargs.get('CALENDAR') # trading calendar, None to probe DATA_PATH day by day
+        self.INTRADAY_ARMA = kwargs.get('INTRADAY_ARMA') # (p, q) of the state-space intraday model, None for the AR(1) recursion
         self.N4ROLLING = int(kwargs['N_HIST_DAY'] / 3)
         self.N4REGRESS = kwargs['N_HIST_DAY'] - self.N4ROLLING
         # self.DATA_PATH = './data_path/' # Tracey to notice
         self._interval = interval
         self._interval_timedelta = timedelta(seconds = self._interval)
-        self._am_n_interval = int(self.HALFTIME.total_seconds() / self._interval_timedelta.total_seconds())
-        self._n_interval = int(self._am_n_interval + ceil(( ( self.T_END_SECS - 60 * 60 * 3.5) / self._interval)))
-        self._features_to_train = np.ones((self.N4REGRESS,3),dtype=float) # CA, M, L, A
+        # the interval of each sec of the day, negative in the breaks, see session_map
+        self._session_map, self._sec_iter = session_map(self._interval, self.SESSIONS)
+        self._n_interval = int(self._session_map[-1]) + 1
+        self._features_to_train = np.ones((self.N4REGRESS + 1,3),dtype=float) # CA, M, L, A
         self._histo_volume = np.full((self.N4REGRESS, self._n_interval),0, dtype=float)  # historical trading volume        
         self._intraday_percentage = [1. / self._n_interval] * self._n_interval  # notice .sum() =self._n_interval
         # self._AR_pars = np.array([1,0],dtype =float) # (u and phi)
         self._AR_pars = [0., 1.] 
+        opening = datetime.combine(date.today(), self.T_START_TIME)
+        self._datetime_index = [str(dt) for start, end in self.SESSIONS
+                                for dt in datetime_range((opening + timedelta(seconds = start)).time(),
+                                                         (opening + timedelta(seconds = end)).time(), self._interval_timedelta)]
+        self._start_day(self.TODAY)
+        self._is_VWAP = 0
+
+        if fitted is not None:
+            self._set_fitted(fitted)
+            return
+
+        try:
+            if history is None:
+                history = self._load_history(ticker)
+            self._fit_history(history)
+            self._is_VWAP = 1
+        except Exception:
+            print 'Error to initialize %s, using TWAP' % ticker
+            self._is_VWAP = 0
+
+    def _start_day(self, today):
+        """Set the trading day and clear the intraday state"""
+
+        self.TODAY = today
+        self.T_START_SEC = time.mktime(datetime.combine(self.TODAY, dt_time(hour = 9, minute = 30, second = 0, microsecond = 0) ).timetuple())
+        self._t_start_nano = int(self.T_START_SEC) * NANO
         self._CA_today = 0
         self._predicted_V = 0.
         self._is_V_predicted = 0
         self._last_update = 0
         self._iter = 0       
-        self._datetime_index = ( [str(dt) for dt in datetime_range(self.T_START_TIME, 
-                                dt_time(hour = 11, minute = 30, second = 0, 
-                                microsecond = 0),timedelta(seconds = self._interval))] + 
-                                [str(dt) for dt in datetime_range(dt_time(hour = 13, 
-                                minute = 0, second = 0, microsecond = 0), 
-                                self.T_END_TIME,timedelta(seconds = self._interval))])
         self._today_vol = [0.] * self._n_interval
         self._p_per = [1. / self._n_interval] * self._n_interval
         self._p_vol = [0] * self._n_interval
         self._cum_vol = 0
+        self._n_tick = 0 # ticks pushed today, held to N_TICK_THRESHOLD like a history day by roll_day
         self._VWAP_log = {}
-        self._is_VWAP = 0
+        self._p_per_scale = 1.
+        self._start_sums()
+        self._start_arma()
+
+    def _start_sums(self):
+        """
+        The running sums push_tick_1 keeps instead of summing lists at every interval
+
+        _p_per_sum is sum(_p_per[0:_last_update + 1]) and _ip_cumsum[i] sum(_intraday_percentage[0:i]),
+        both added up in list order like sum(). The intervals after _last_update hold their
+        pattern values, the day's p_per of them is _p_per_scale times those, and
+        _p_per_suffix[i] is sum(_p_per[i:]) of the pattern values to rescale them in one step.
+        """
+
+        self._ip_cumsum = [0.]
+        for s in self._intraday_percentage:
+            self._ip_cumsum.append(self._ip_cumsum[-1] + s)
+
+        self._p_per_sum = 0
+        for s in self._p_per[0:(self._last_update + 1)]:
+            self._p_per_sum += s
+
+        self._p_per_suffix = [0.] * (self._n_interval + 1)
+        for i in range(self._n_interval - 1, self._last_update, -1):
+            self._p_per_suffix[i] = self._p_per_suffix[i + 1] + self._p_per[i]
+
+    def _start_arma(self):
+        """Reset the state-space intraday filter, if any, to before the first interval"""
+
+        if self._arma_system():
+            self._state_mean, self._state_cov = kalman_start(self._ARMA_pars, *self._ARMA_order)
+
+    def _arma_system(self):
+        """
+        Set the T and Q of the state-space intraday model once for the day, see arma_system
+
+        _ARMA_order is the (p, q) _ARMA_pars were fitted for; pars saved without it are
+        taken for INTRADAY_ARMA, or dropped for the AR(1) recursion if there is none.
+
+        Returns:
+            True if the ticker runs the state-space model
+        """
+
+        if not hasattr(self, '_ARMA_pars'):
+            return False
+        if not hasattr(self, '_ARMA_order'):
+            if self.INTRADAY_ARMA is None:
+                del self._ARMA_pars
+                return False
+            self._ARMA_order = tuple(self.INTRADAY_ARMA)
+
+        self._arma_T, self._arma_Q = arma_system(self._ARMA_pars, *self._ARMA_order)
+
+        return True
+
+    def roll_day(self, next_day):
+        """
+        End of day: slide the history window one day forward with today's ticks and refit
+
+        The oldest regression day leaves _histo_volume and the CA column of _features_to_train
+        for the rolling totals, whose oldest day is dropped, and today's _today_vol and call
+        auction volume are appended. The Lasso, intraday pattern and AR(1) are fitted again
+        on the new window.
+
+        Returns:
+            True if rolled, False if today is unusable for the window (no VWAP model, fewer
+            than N_TICK_THRESHOLD ticks, no call auction or no volume) or the refit fails;
+            the object should then be rebuilt from the history files
+        """
+
+        if self._is_VWAP != 1 or self._n_tick < self.N_TICK_THRESHOLD or self._CA_today < 1 or sum(self._today_vol) <= 0:
+            return False
+
+        history = {
+            'ca': np.append(self._features_to_train[1:self.N4REGRESS,0], self._CA_today),
+            'histo_volume': np.vstack([self._histo_volume[1:], np.array(self._today_vol, dtype=float)]),
+            'volume_sums': np.append(self._volume_sums[1:], self.volume_to_train[0]),
+            'n_day': self.N4REGRESS + self.N4ROLLING
+        }
 
-        tickercsv = ticker + '.csv'
-        
+        self._start_day(next_day)
         try:
-            histo_date = self.TODAY
-            past_days = 0
-            x_output = np.concatenate((np.arange(0 + self._interval , 7200 + self._interval, self._interval), 
-                                np.arange(12600 + self._interval, self.T_END_SECS, self._interval), np.array([self.T_END_SECS])), axis = 0)
+            self._fit_history(history)
+        except Exception:
+            print 'Error to roll %s to %s, using TWAP' % (self.ticker, str(next_day))
+            self._is_VWAP = 0
+            return False
 
-            iter = 1
-            
-            while iter < (self.N4REGRESS + 1):
+        return True
 
-                if not bool(dates):
-                    raise Exception('Insufficient historical data')
+    def _load_history(self, ticker):
+        """Walk back from TODAY for this ticker's history days, see _fit_history for the result"""
 
-                histo_date = histo_date - timedelta(days = 1)
-                past_days += 1
+        tickercsv = ticker + '.csv'
+        ca = np.zeros(self.N4REGRESS, dtype=float)
+        histo_volume = np.full((self.N4REGRESS, self._n_interval),0, dtype=float)
+        volume_sums = np.zeros(self.N4ROLLING, dtype=float)
+        iter = 1
 
-                # if histo_date.weekday() in set([5,6]):
-                #    continue
+        for histo_date, past_days in self._history_dates(ticker):
 
-                histo_date_str = histo_date.strftime("%Y%m%d")
-                if histo_date_str not in dates:
-                    continue
-                dates.remove(histo_date_str)
+            if iter == self.N4REGRESS + self.N4ROLLING + 1:
+                break
 
-                try:
-                    dat = pd.read_csv(self.DATA_PATH + histo_date_str + '/' + tickercsv, header = 0)
-                except Exception:
-                    print 'Error in reading %s for %s, go to the previous day.' % (tickercsv, str(histo_date))
-                    continue
+            meta = None if self.CALENDAR is None else day_meta(self.CALENDAR, ticker, histo_date.strftime("%Y%m%d"))
+            day = read_history_day(ticker, histo_date, self.DATA_PATH, self.STORE_PATH, self.T_END_SECS,
+                                   meta, need_volume = iter < (self.N4REGRESS + 1))
+            if day is None:
+                continue
 
-                if dat.shape[0] < self.N_TICK_THRESHOLD:
-                    print '%s in %s has few data for prediction' % (tickercsv, str(histo_date))
-                    continue
+            if day['n_tick'] < self.N_TICK_THRESHOLD:
+                print '%s in %s has few data for prediction' % (tickercsv, str(histo_date))
+                continue
 
+            if iter < (self.N4REGRESS + 1):
                 if past_days > 2 * self.N4REGRESS:
                     warnings.warn('Lack historical data. Time span of data for predicting intraday_volume of today has exceeded 2 times the desired days.'
                                     'We are using data %d days from today' % past_days) 
 
-                try:
-                    dat.Nano = dat.Nano / 1e9 - time.mktime(datetime.combine(histo_date, dt_time(hour = 9, minute = 30, second = 0, microsecond = 0)).timetuple())
-                    tmp_Volume = np.array(dat.Volume)
-                    dat.Volume = list(np.append(tmp_Volume[0], tmp_Volume[1:] - tmp_Volume[:-1]) )
-                    dat = dat.as_matrix(columns = ['Nano', 'Volume']) # there will be Microsecond
-                    datCA = dat[dat[:,0] < 0][:,1].sum() # Tracey to notice
-                    if datCA < 1: # no data or no trade ?
-                        continue
-                    
-                    self._features_to_train[self.N4REGRESS - iter,0] = datCA
-                    dat = dat[dat[:,0] > 0]
-
-                    # Tracey by reviewing the data from ctp finds it impossible
-                    if any( 7200 < t < 7230 for t in dat[:,0]): # tracey_to_notice
-                        dat = np.vstack( (dat[dat[:, 0] < 7200], [7200, dat[(dat[:,0] >= 7200)*(dat[:,0] < 7230),1].sum()], dat[dat[:, 0] > 7230]))
-                    if any(t >= 19800 for t in dat[:,0]):
-                        dat = np.vstack((dat[dat[:, 0] < 19800], [19800,dat[dat[:,0] >= 19800,1].sum()])) # tracey to notice
-
-                    dat[-1,0] = 19800
-
-                    x_input = np.append(0, dat[:,0])
-                    volume_cumsum = np.append(0,dat[:,1].cumsum())
-                    # volume_cumsum = np.append(0, dat[:, 1]) # tracey to notice
-                    y_interp = scipy.interpolate.interp1d(x_input,volume_cumsum) # ,interval)
-                    intraday_volume = y_interp(x_output)
-                    intraday_volume = np.append(intraday_volume[0],(intraday_volume[1:] - intraday_volume[:-1]))
-                    self._histo_volume[self.N4REGRESS - iter] = intraday_volume # replace _histo_volume at row self.N4TREGRSS - iter
-                except Exception:
-                    print 'Error when read %s at %s, you may check its format' % (ticker, histo_date_str) 
+                if day['ca'] < 1: # no data or no trade ?
                     continue
 
-                iter += 1
+                ca[self.N4REGRESS - iter] = day['ca']
+                histo_volume[self.N4REGRESS - iter] = interval_volume(day['volume'], self._interval, self.SESSIONS) # replace _histo_volume at row self.N4TREGRSS - iter
+            else:
+                if past_days > 3 * self.N4REGRESS:
+                    warnings.warn('Lack efficacious historical data. Time span of data for predicting total trading volume of today has exceeded 3 times the desired days.')
+
+                volume_sums[self.N4REGRESS + self.N4ROLLING - iter] = day['total']
+
+            iter += 1
+
+        return {'ca': ca, 'histo_volume': histo_volume, 'volume_sums': volume_sums, 'n_day': iter - 1}
+
+    def _history_dates(self, ticker):
+        """
+        (histo_date, past_days) of the candidate history days of ticker, newest first
+
+        With a trading calendar these are its dates of the ticker with enough ticks and
+        past_days counts trading days, otherwise every day before TODAY is probed for a
+        date directory and past_days counts calendar days.
+        """
+
+        today_str = self.TODAY.strftime("%Y%m%d")
+
+        if self.CALENDAR is not None:
+            for histo_date_str in trading_days(self.CALENDAR, ticker, today_str, self.N_TICK_THRESHOLD):
+                yield (datetime.strptime(histo_date_str, "%Y%m%d").date(),
+                       trading_days_back(self.CALENDAR, histo_date_str, today_str))
+            return
+
+        dates = set(d for d in listdir(self.DATA_PATH) if d < today_str)
+        histo_date = self.TODAY
+        past_days = 0
+        while bool(dates):
+
+            histo_date = histo_date - timedelta(days = 1)
+            past_days += 1
+
+            # if histo_date.weekday() in set([5,6]):
+            #    continue
+
+            histo_date_str = histo_date.strftime("%Y%m%d")
+            if histo_date_str not in dates:
+                continue
+            dates.remove(histo_date_str)
+
+            yield histo_date, past_days
+
+    def _fit_history(self, history):
+        """
+        Fit the daily volume features, intraday pattern and AR(1) from a history
+
+        Args:
+            history: a dict of
+                ca: call auction volumes of the N4REGRESS regression days, oldest first
+                histo_volume: their volumes in each interval
+                volume_sums: session totals of the N4ROLLING days before them, oldest first
+                n_day: the number of days found, N4REGRESS + N4ROLLING when complete
+                pattern, ar_pars: optional, the intraday_pattern and fit_ar1 of the
+                    history fitted already, see load_histories
+        """
+
+        if history['n_day'] < self.N4REGRESS + self.N4ROLLING:
+            raise Exception('Insufficient historical data')
+
+        self._features_to_train[0:self.N4REGRESS,0] = history['ca']
+        self._histo_volume = history['histo_volume']
+        self._volume_sums = history['volume_sums']
+
+        # preparing sample for predicting today's total volume
+        self.volume_to_train = self._histo_volume.sum(axis = 1) # TODO na skip
+        volume_sums = np.append(self._volume_sums, self.volume_to_train)
+        self._features_to_train[:,1] = rolling_mean(volume_sums, self.N4ROLLING)
+        self._features_to_train[:,2] = rolling_linear(volume_sums, self.N4ROLLING)
+        self._fit_lasso()
+
+        # get intraday pattern and intialize intraday prediction
+        self._p_vol[0] = int(self._histo_volume[:,0].mean())
+        tmp = history['pattern'] if 'pattern' in history else intraday_pattern(self._histo_volume)
+        self._p_per = list(tmp / self._n_interval)
+        self._intraday_percentage = list(tmp)
+        # self._p_per = self._intraday_percentage / self._n_interval
+        # self._p_per[0] = self._intraday_percentage[0] / self._n_interval
+        
+        self._VWAP_log[self._datetime_index[0]] = get_log(None, self._p_vol[0], self._p_per[0])         
+        self._start_sums()
+        
+        # compute AR
+        if 'ar_pars' in history:
+            self._AR_pars = history['ar_pars'].tolist()
+        else:
+            self._AR_pars = fit_ar1(self._histo_volume[-1] / self._intraday_percentage).tolist()
+        if self.INTRADAY_ARMA is not None:
+            self._ARMA_pars = fit_arma(self._histo_volume[-1] / self._intraday_percentage, *self.INTRADAY_ARMA)
+            self._ARMA_order = tuple(self.INTRADAY_ARMA)
+            self._start_arma()
+        
+
+    def _get_fitted(self):
+        """The fitted state of FITTED_ATTRS, only _is_VWAP for a TWAP ticker"""
 
-            volume_sums = np.zeros(self.N4ROLLING, dtype=float)
-            while iter < (self.N4REGRESS + self.N4ROLLING + 1):
+        if self._is_VWAP != 1: # the defaults of a bare VWAP, whatever a failed fit left behind
+            return {'_is_VWAP': self._is_VWAP}
 
-                if not bool(dates):
-                    raise Exception('Insufficient historical data')
+        return dict((name, getattr(self, name)) for name in self.FITTED_ATTRS if hasattr(self, name))
 
-                histo_date = histo_date - timedelta(days = 1)
-                past_days += 1
+    def _set_fitted(self, fitted):
 
-                # if histo_date.weekday() in set([5,6]):
-                #     continue
+        for name, value in fitted.items():
+            setattr(self, name, value)
+        self._start_sums()
+        self._start_arma()
 
-                histo_date_str = histo_date.strftime("%Y%m%d")
-                if histo_date_str not in dates:
-                    continue
-                dates.remove(histo_date_str)
+    def _state_layout(self):
+        """The interval layout a state is saved for: interval, T_END_SECS, n_interval and SESSIONS"""
 
-                try:
-                    dat = pd.read_csv(self.DATA_PATH + histo_date_str + '/' + tickercsv, header = 0)
-                except Exception:
-                    print 'Error in reading %s for %s, go to the previous day.' % (tickercsv, str(histo_date)) 
-                    continue     
+        return {'interval': np.array(self._interval), 'T_END_SECS': np.array(self.T_END_SECS),
+                'n_interval': np.array(self._n_interval), 'SESSIONS': np.array(self.SESSIONS, dtype = np.int64)}
 
-                if dat.shape[0] < self.N_TICK_THRESHOLD:
-                    print '%s in %s has few data for prediction' % (tickercsv, str(histo_date)) 
-                    continue   
+    def _get_state(self):
+        """TODAY, the interval layout, FITTED_ATTRS and INTRADAY_ATTRS as numpy arrays"""
 
-                if past_days > 3 * self.N4REGRESS:
-                    warnings.warn('Lack efficacious historical data. Time span of data for predicting total trading volume of today has exceeded 3 times the desired days.')
+        state = self._state_layout()
+        state['TODAY'] = np.array(self.TODAY.toordinal())
+        for name in self.FITTED_ATTRS + self.INTRADAY_ATTRS:
+            if not hasattr(self, name):
+                continue
+            value = getattr(self, name)
+            if name == '_VWAP_log':
+                value = log_to_array(value, self._datetime_index)
+            state[name] = np.asarray(value)
 
-                try:
-                    dat.Nano = dat.Nano / 1e9 - time.mktime(datetime.combine(histo_date, dt_time(hour = 9, minute = 30, second = 0, microsecond = 0)).timetuple())                
-                    tmp_Volume = np.array(dat.Volume)
-                    dat.Volume = list(np.append(tmp_Volume[0], tmp_Volume[1:] - tmp_Volume[:-1]))            
-                    dat = dat.as_matrix(columns = ['Nano', 'Volume']) # there will be Microsecond
-                    volume_sums[self.N4REGRESS + self.N4ROLLING - iter] = dat[ (dat[:,0] > 0) * (dat[:,0] < self.T_END_SECS),1].sum()
-                except Exception:
-                    print 'Error when read %s at %s, you may check its format' % (ticker, histo_date_str) 
-                    continue
+        return state
 
-                iter += 1
+    def _set_state(self, state):
 
-            # preparing sample for predicting today's total volume
-            self.volume_to_train = self._histo_volume.sum(axis = 1) # TODO na skip
-            volume_sums = np.append(volume_sums, self.volume_to_train)
-            self._features_to_train[:,1] = rolling_mean(volume_sums, self.N4ROLLING)
-            self._features_to_train[:,2] = rolling_linear(volume_sums, self.N4ROLLING)
+        layout = self._state_layout()
+        for name, value in layout.items():
+            if name not in state:
+                raise ValueError('state has no %s' % name)
+            if not np.array_equal(state[name], value):
+                raise ValueError('state is for %s %s, not %s' % (name, state[name].tolist(), value.tolist()))
 
-            # get intraday pattern and intialize intraday prediction
-            intraday_mean = self._histo_volume.mean(axis = 0) # TODO na skip
-            self._p_vol[0] = int(intraday_mean[0])
-            # self._intraday_percentage = list(np.divide(intraday_mean, intraday_mean.sum()) * self._n_interval)
-            
-            tmp = np.divide(intraday_mean, intraday_mean.sum()) * self._n_interval
-            # print tmp # Tracey to notice
-            if np.any(tmp < 0.1):
-                warnings.warn('adjust intraday trading volume pattern for irregular data')
-                tmp[tmp >= 0.1] = tmp[tmp > 0.1] * (self._n_interval - 0.1 * len(tmp[tmp < 0.1])) / sum(tmp[tmp >= 0.1])
-                tmp[tmp < 0.1] = 0.1
-            self._p_per = list(tmp / self._n_interval)
-            self._intraday_percentage = list(tmp)
-            # self._p_per = self._intraday_percentage / self._n_interval
-            # self._p_per[0] = self._intraday_percentage[0] / self._n_interval
-            
-            self._VWAP_log[self._datetime_index[0]] = get_log(None, self._p_vol[0], self._p_per[0])         
-            
-            # compute AR
-            arma = ARMA( self._histo_volume[-1] / self._intraday_percentage, order = (1,0))
-            self._AR_pars = arma.fit().params.tolist()
-            
-            self._is_VWAP = 1
-        except Exception:
-            print 'Error to initialize %s, using TWAP' % ticker
-            self._is_VWAP = 0
+        self._start_day(date.fromordinal(int(state['TODAY'])))
+        for name, value in state.items():
+            if name == 'TODAY' or name in layout:
+                continue
+            if name == '_VWAP_log':
+                value = log_from_array(value, self._datetime_index)
+            elif value.ndim == 0:
+                value = value.item()
+            elif name in self.LIST_ATTRS:
+                value = value.tolist()
+            setattr(self, name, value)
+        self._start_sums()
+        self._arma_system()
+
+    def save_state(self, file_path):
+        """
+        Write the fitted model and the day so far to a binary (npz) file
+
+        A restarted process gets the object back with load_state, without reading
+        history files or fitting, and carries on pushing ticks where it stopped.
+        """
+
+        with open(file_path + '.tmp', 'wb') as f:
+            np.savez(f, **self._get_state())
+        rename(file_path + '.tmp', file_path)
+
+    def load_state(self, file_path):
+
+        data = np.load(file_path)
+        try:
+            self._set_state(dict((name, data[name]) for name in data.files))
+        finally:
+            data.close()
+
+    def _fit_lasso(self):
+        """Fit the daily volume Lasso ahead of the open, only today's CA feature is left for pred_V"""
+
+        w, b = fit_lasso(self._features_to_train[0:-1,:], self.volume_to_train, self.LASSO_LAMBDA)
+        self._lasso_coef = np.append(w, b)
 
     def pred_V(self):
-        
+
+        if not hasattr(self, '_lasso_coef'): # restored from a state saved without it
+            self._fit_lasso()
+        self._set_predicted_V(np.dot(self._today_features(), self._lasso_coef[:-1]) + self._lasso_coef[-1])
+
+    def _today_features(self):
+        """Today's row of _features_to_train, with the call auction volume so far"""
+
         if self._CA_today == 0:
             self._features_to_train[self.N4REGRESS,0] = self._features_to_train[-1,0].mean()
         else:
             self._features_to_train[self.N4REGRESS,0] = self._CA_today
-        
-        lm = Lasso(alpha = self.LASSO_LAMBDA)
-        lm.fit(self._features_to_train[0:-1,:],self.volume_to_train)
-        self._predicted_V = int(lm.predict(self._features_to_train[-1].reshape(1,-1))[0])
+
+        return self._features_to_train[-1]
+
+    def _set_predicted_V(self, V):
+
+        self._predicted_V = int(V)
         if self._predicted_V < 0: 
             warnings.warn('We some how get a exceeding low volume prediction for today. We strongly urge you check your tick data.')
             self._predicted_V = 1 # Tr 1 acey to notice
@@ -322,34 +1335,136 @@ class VWAP(object):
     
     def get_predict(self, nano):
         
-        sec_time =int(nano / 1e9 - self.T_START_SEC)
+        sec_time = (int(nano) - self._t_start_nano) // NANO
 
         if sec_time < 0 or sec_time >=  self.T_END_SECS:
             return 0.
         
         else:
-            iter = int(sec_time / self._interval)
+            iter = self._sec_iter[sec_time]
 
-            if iter > self._am_n_interval: # in the afternoon
-                iter -= int(self._am_n_interval * 3 / 4)
+            if iter < 0: # in a break
+                return 0.
             
+            if iter > self._last_update: # still scaled lazily, see _start_sums
+                return self._p_per[iter] * self._p_per_scale
+
             return self._p_per[iter]
 
+    def get_predicts(self, nanos):
+        """get_predict of a batch of nanos"""
+
+        sec_time, iters = session_iters(nanos, self._t_start_nano, self._session_map)
+        p_per = np.asarray(self._p_per)[iters] * np.where(iters > self._last_update, self._p_per_scale, 1.)
+
+        return np.where((sec_time < 0) | (sec_time >= self.T_END_SECS) | (iters < 0), 0., p_per)
+
     def push_tick(self, nano, cum_volume):
         
         if self._is_VWAP == 1:
+            self._n_tick += 1
             self.push_tick_1(nano, cum_volume)
         else:
             pass
 
 
+    def push_ticks(self, nanos, cum_volumes):
+        """
+        push_tick for a batch of one day's ticks, in the order received
+
+        The ticks are bucketed into push_tick_1's intervals and differenced in bulk.
+        Consecutive ticks falling in the same interval (or in the call auction) are a
+        run: its first tick goes through push_tick_1, which does the rollover if any,
+        and the others only add their volume, which is all push_tick_1 does with them.
+        The Python work is per interval rather than per tick and the state is exactly
+        what pushing the ticks one by one gives.
+        """
+
+        if self._is_VWAP != 1 or len(nanos) == 0:
+            return
+
+        self._n_tick += len(nanos)
+        nanos = np.asarray(nanos)
+        cum_volumes = np.asarray(cum_volumes)
+
+        # push_tick_1's interval of every tick, -1 in the call auction
+        sec_time, iters = session_iters(nanos, self._t_start_nano, self._session_map)
+        iters = np.where(sec_time < self.T_END_SECS, iters % self._n_interval, self._n_interval - 1)
+        iters[sec_time < 0] = -1
+
+        starts = np.flatnonzero(np.append(True, iters[1:] != iters[:-1]))
+        ends = np.append(starts[1:], len(iters))
+        volumes = np.diff(cum_volumes, prepend = self._cum_vol)
+        # integer volumes add up the same in any order, float ones are added one by one
+        exact = volumes.dtype.kind in 'iu'
+        rest_volumes = (np.add.reduceat(volumes, starts) - volumes[starts]).tolist()
+
+        # push_tick_1 complains about every tick out of the day, not only the first of a run
+        illegal = np.ones(len(nanos), dtype = bool)
+        illegal[starts] = False
+        for sec in sec_time[illegal & ((sec_time < -900) | (sec_time > self.T_END_SECS))].tolist():
+            print 'Illegal nano, too early for today' if sec < -900 else 'Illegal nano, too late for today'
+
+        def added(total, start, end, rest_volume):
+            """total plus the volumes of a run after its first tick, tick by tick when the order matters"""
+            if exact and float(total).is_integer():
+                return total + rest_volume
+            for volume in volumes[start + 1:end].tolist():
+                total += volume
+            return total
+
+        nanos = nanos.tolist()
+        cum_volumes = cum_volumes.tolist()
+        iters = iters.tolist()
+
+        for start, end, rest_volume in zip(starts.tolist(), ends.tolist(), rest_volumes):
+            self.push_tick_1(nanos[start], cum_volumes[start])
+            if end - start == 1:
+                continue
+
+            if iters[start] < 0:
+                self._CA_today = added(self._CA_today, start, end, rest_volume)
+            elif self._iter == self._last_update: # otherwise behind the last interval updated, push_tick_1 drops it
+                self._today_vol[self._iter] = added(self._today_vol[self._iter], start, end, rest_volume)
+            self._cum_vol = cum_volumes[end - 1]
+
+    def _next_p_vol(self, i):
+        """Predicted volume of interval i + 1 once interval i is done, by the AR(1) recursion or the state-space filter"""
+
+        if not hasattr(self, '_ARMA_pars'):
+            return int ((self._AR_pars[1] * (self._today_vol[i] / self._intraday_percentage[i] - self._AR_pars[0] ) + self._AR_pars[0] ) * self._intraday_percentage[i + 1])
+
+        mean = self._ARMA_pars[0]
+        self._state_mean, self._state_cov = kalman_step(self._state_mean, self._state_cov,
+                                                        self._today_vol[i] / self._intraday_percentage[i] - mean,
+                                                        self._arma_T, self._arma_Q)
+
+        return int((self._state_mean[0] + mean) * self._intraday_percentage[i + 1])
+
+    def _set_next_p_per(self, i):
+        """
+        p_per of interval i + 1 from its p_vol, keeping _p_per_sum at sum(p_per[0:i + 2])
+
+        Returns:
+            sum(p_per[0:i + 1]), the running sum before interval i + 1
+        """
+
+        p_per_sum = self._p_per_sum
+        if i + 2 < self._n_interval:
+            self._p_per[i + 1] = self._p_vol[i + 1] * (1 - p_per_sum) / (self._predicted_V * (1 - self._ip_cumsum[i + 1]/ self._n_interval ))
+        else:
+            self._p_per[self._n_interval - 1] = 1 - p_per_sum
+        self._p_per_sum = p_per_sum + self._p_per[i + 1]
+
+        return p_per_sum
+
     def push_tick_1(self, nano, cum_volume):
 
         volume = cum_volume - self._cum_vol
 
         self._cum_vol = cum_volume
 
-        sec_time =int(nano / 1e9 - self.T_START_SEC)
+        sec_time = (int(nano) - self._t_start_nano) // NANO
 
         if sec_time < -900:
             print 'Illegal nano, too early for today'
@@ -364,10 +1479,12 @@ class VWAP(object):
             if not self._is_V_predicted:
                 self.pred_V()
 
-            iter = int(sec_time / self._interval)
-
-            if iter > self._am_n_interval: # in the afternoon
-                iter -= int(self._am_n_interval * 3 / 4)
+            if sec_time < self.T_END_SECS:
+                iter = self._sec_iter[sec_time]
+                if iter < 0: # in a break, booked into the interval before it
+                    iter += self._n_interval
+            else:
+                iter = self._n_interval
             self._iter = iter
             
             if self._iter < self._n_interval: # time hasn't exceeded market close time
@@ -384,21 +1501,19 @@ class VWAP(object):
                     for i in range(self._last_update, self._iter):
                         self._VWAP_log[self._datetime_index[i]] = get_log(self._today_vol[i], self._p_vol[i], self._p_per[i])
                         try: # bug
-                            self._p_vol[i + 1] = int ((self._AR_pars[1] * (self._today_vol[i] / self._intraday_percentage[i] - self._AR_pars[0] ) + self._AR_pars[0] ) * self._intraday_percentage[i + 1])
+                            self._p_vol[i + 1] = self._next_p_vol(i)
                         except OverflowError:
                             print self._today_vol[i]
                             print self._intraday_percentage[i]
                             print self._intraday_percentage[i + 1]
 
-                        if i + 2 < self._n_interval:
-                            self._p_per[i + 1] = self._p_vol[i + 1] * (1 - sum(self._p_per[0:(i + 1)])) / (self._predicted_V * (1 - sum(self._intraday_percentage[0:(i + 1)])/ self._n_interval ))
-                        else:
-                            self._p_per[self._n_interval - 1] = 1 - sum(self._p_per[0:(self._n_interval - 1)])
+                        p_per_sum = self._set_next_p_per(i)
                         self._VWAP_log[self._datetime_index[i + 1]] = get_log(None, self._p_vol[i + 1], self._p_per[i + 1])
 
                     self._last_update = self._iter
                     
-                    self._p_per[(self._iter + 1):self._n_interval] = [ (1 - sum(self._p_per[0:(i + 1)])) / (sum(self._p_per[(self._iter + 1):self._n_interval])) * s for s in self._p_per[(self._iter + 1):self._n_interval]]
+                    if self._iter + 1 < self._n_interval: # scale the rest of the day to 1 - sum(p_per[0:iter]), applied lazily
+                        self._p_per_scale = (1 - p_per_sum) / self._p_per_suffix[self._iter + 1]
                     
             else: # self._iter has exceed the send of the market close time 
                 self._iter = self._n_interval - 1
@@ -414,17 +1529,266 @@ class VWAP(object):
 
                     for i in range(self._last_update, self._iter):
                         self._VWAP_log[self._datetime_index[i]] = get_log(self._today_vol[i], self._p_vol[i], self._p_per[i])
-                        self._p_vol[i + 1] = int ((self._AR_pars[1] * (self._today_vol[i] / self._intraday_percentage[i] - self._AR_pars[0] ) + self._AR_pars[0] ) * self._intraday_percentage[i + 1])
+                        self._p_vol[i + 1] = self._next_p_vol(i)
                         
-                        if i + 2 < self._n_interval:
-                            self._p_per[i + 1] = self._p_vol[i + 1] * (1 - sum(self._p_per[0:(i + 1)])) / (self._predicted_V * (1 - sum(self._intraday_percentage[0:(i + 1)])/ self._n_interval ))
-                        else:
-                            self._p_per[self._n_interval - 1] = 1 - sum(self._p_per[0:(self._n_interval - 1)])
+                        p_per_sum = self._set_next_p_per(i)
                         self._VWAP_log[self._datetime_index[i + 1]] = get_log(None, self._p_vol[i + 1], self._p_per[i + 1])
 
                     self._last_update = self._iter                    
 
 
+def py2_round(x):
+    """round() of python 2 on an array: halves away from zero"""
+
+    r = np.floor(np.abs(x) + 0.5)
+    r[r - np.abs(x) > 0.5] -= 1 # x + 0.5 rounded up to the next integer
+
+    return np.copysign(r, x)
+
+
+class VWAPBook(object):
+    """
+    The intraday state of many tickers in tickers x intervals arrays, for mixed tick batches
+
+    Built from VWAP objects of one interval and day, VWAP_handler.tickers for instance, it
+    carries on from where they are. push_ticks and get_predict give what the objects'
+    would, with numpy operations across tickers instead of a Python call per tick.
+    Tickers on TWAP keep its flat prediction and ignore their ticks. Only the AR(1)
+    intraday recursion is run, tickers on the state-space model are refused.
+    """
+
+    def __init__(self, vwaps):
+
+        self.tickers = sorted(vwaps)
+        self.index = dict((ticker, i) for i, ticker in enumerate(self.tickers))
+        vwaps = [vwaps[ticker] for ticker in self.tickers]
+        ref = vwaps[0]
+        for vwap in vwaps:
+            if vwap._interval != ref._interval or vwap.TODAY != ref.TODAY or vwap.SESSIONS != ref.SESSIONS:
+                raise ValueError('the VWAP objects of a book must share the interval, day and trading sessions')
+            if hasattr(vwap, '_ARMA_pars'):
+                raise ValueError('%s uses the state-space intraday model, which VWAPBook does not run' % vwap.ticker)
+            if vwap._is_VWAP == 1 and not hasattr(vwap, '_lasso_coef'): # restored from a state saved without it
+                vwap._fit_lasso()
+
+        self._interval = ref._interval
+        self._session_map = ref._session_map
+        self._n_interval = ref._n_interval
+        self._datetime_index = ref._datetime_index
+        self.T_START_SEC = ref.T_START_SEC
+        self._t_start_nano = ref._t_start_nano
+        self.T_END_SECS = ref.T_END_SECS
+
+        def rows(name, dtype = float):
+            return np.array([getattr(vwap, name) for vwap in vwaps], dtype = dtype)
+
+        self._active = np.array([vwap._is_VWAP == 1 for vwap in vwaps])
+        self._intraday_percentage = rows('_intraday_percentage')
+        self._ip_cumsum = rows('_ip_cumsum')
+        self._p_per_suffix = rows('_p_per_suffix')
+        self._AR_pars = rows('_AR_pars')
+        self._lasso_coef = np.array([vwap._lasso_coef if vwap._is_VWAP == 1 else np.zeros(4) for vwap in vwaps])
+        self._features = np.array([vwap._features_to_train[-1] for vwap in vwaps])
+        self._today_vol = rows('_today_vol')
+        self._p_vol = rows('_p_vol')
+        self._p_per = rows('_p_per')
+        self._CA_today = rows('_CA_today')
+        self._predicted_V = rows('_predicted_V')
+        self._is_V_predicted = rows('_is_V_predicted', bool)
+        self._last_update = rows('_last_update', int)
+        self._iter = rows('_iter', int)
+        self._cum_vol = rows('_cum_vol')
+        self._p_per_sum = rows('_p_per_sum')
+        self._p_per_scale = rows('_p_per_scale')
+
+    def push_ticks(self, indices, nanos, cum_volumes):
+        """
+        Push a batch of ticks of any tickers, in the order received
+
+        The ticks of a ticker are taken in order and cut into runs in one interval (or
+        the call auction) like VWAP.push_ticks. The k-th runs of all the tickers are then
+        pushed together, the first tick of each doing its rollover, if any.
+
+        Args:
+            indices: the index of each tick's ticker in self.tickers
+            nanos, cum_volumes: the ticks, as VWAP.push_tick takes them
+        """
+
+        indices = np.asarray(indices, dtype = int)
+        nanos = np.asarray(nanos)
+        cum_volumes = np.asarray(cum_volumes)
+        keep = self._active[indices]
+        order = np.argsort(indices[keep], kind = 'mergesort') # stable, each ticker's ticks keep their order
+        tickers = indices[keep][order]
+        nanos = nanos[keep][order]
+        cum_volumes = cum_volumes[keep][order].astype(float)
+        if len(tickers) == 0:
+            return
+
+        # push_tick_1's interval of every tick, -1 in the call auction
+        sec_time, iters = session_iters(nanos, self._t_start_nano, self._session_map)
+        for sec in sec_time[(sec_time < -900) | (sec_time > self.T_END_SECS)].tolist():
+            print 'Illegal nano, too early for today' if sec < -900 else 'Illegal nano, too late for today'
+        iters = np.where(sec_time < self.T_END_SECS, iters % self._n_interval, self._n_interval - 1)
+        iters[sec_time < 0] = -1
+
+        first = np.append(True, tickers[1:] != tickers[:-1])
+        volumes = cum_volumes - np.where(first, self._cum_vol[tickers], np.append(0., cum_volumes[:-1]))
+        starts = np.flatnonzero(first | np.append(True, iters[1:] != iters[:-1]))
+        ends = np.append(starts[1:], len(tickers))
+        rest_volumes = np.add.reduceat(volumes, starts) - volumes[starts]
+        # integer volumes add up the same in any order, others are added one by one
+        exact = bool(np.all(volumes == np.floor(volumes)))
+
+        # the rank of each run among its ticker's runs, runs of one rank are pushed together
+        new_ticker = first[starts]
+        rank = np.arange(len(starts)) - np.flatnonzero(new_ticker)[np.cumsum(new_ticker) - 1]
+        by_rank = np.argsort(rank, kind = 'mergesort')
+        bounds = np.searchsorted(rank[by_rank], np.arange(rank.max() + 2))
+
+        for k in range(rank.max() + 1):
+            runs = by_rank[bounds[k]:bounds[k + 1]]
+            s = starts[runs]
+            self._push_runs(tickers[s], s, ends[runs], sec_time[s], iters[s], volumes, cum_volumes,
+                            rest_volumes[runs], exact)
+
+    def _push_runs(self, t, starts, ends, sec_time, iters, volumes, cum_volumes, rest_volumes, exact):
+        """Push one run of ticks of each of the tickers t, at most one run per ticker"""
+
+        volume = volumes[starts]
+        self._cum_vol[t] = cum_volumes[starts]
+
+        ca = sec_time < 0
+        self._CA_today[t[ca]] += volume[ca]
+
+        op = ~ca
+        t_op = t[op]
+        self._pred_V(t_op[~self._is_V_predicted[t_op]])
+        self._iter[t_op] = iters[op]
+        last_update = self._last_update[t_op]
+        same = iters[op] == last_update
+        self._today_vol[t_op[same], iters[op][same]] += volume[op][same]
+        roll = last_update < iters[op]
+        if np.any(roll):
+            self._roll(t_op[roll], last_update[roll], iters[op][roll], volume[op][roll], sec_time[op][roll] < self.T_END_SECS)
+
+        # the rest of the runs only add volume
+        more = ends - starts > 1
+        ca_more = more & ca
+        self._CA_today[t[ca_more]] = self._added(self._CA_today[t[ca_more]], starts[ca_more], ends[ca_more],
+                                                 rest_volumes[ca_more], volumes, exact)
+        on = np.zeros(len(t), dtype = bool)
+        on[op] = self._iter[t_op] == self._last_update[t_op] # otherwise behind the last interval updated, dropped
+        op_more = more & on
+        t_more = t[op_more]
+        self._today_vol[t_more, self._iter[t_more]] = self._added(self._today_vol[t_more, self._iter[t_more]], starts[op_more],
+                                                                  ends[op_more], rest_volumes[op_more], volumes, exact)
+        self._cum_vol[t] = cum_volumes[ends - 1]
+
+    def _added(self, totals, starts, ends, rest_volumes, volumes, exact):
+        """totals plus the volumes of runs after their first tick, tick by tick where the order matters"""
+
+        out = totals + rest_volumes
+        slow = np.flatnonzero(~(exact & (totals == np.floor(totals))))
+        if len(slow):
+            lengths = ends[slow] - starts[slow]
+            sums = totals[slow].copy()
+            for m in range(1, lengths.max()):
+                more = lengths > m
+                sums[more] += volumes[starts[slow][more] + m]
+            out[slow] = sums
+
+        return out
+
+    def _pred_V(self, t):
+        """VWAP.pred_V of the tickers t"""
+
+        if len(t) == 0:
+            return
+
+        ca = self._CA_today[t]
+        self._features[t, 0] = np.where(ca == 0, self._features[t, 0], ca)
+        V = np.trunc(np.einsum('tj,tj->t', self._features[t], self._lasso_coef[t, :-1]) + self._lasso_coef[t, -1])
+        if np.any(V < 0):
+            warnings.warn('We some how get a exceeding low volume prediction for today. We strongly urge you check your tick data.')
+            V[V < 0] = 1
+        self._predicted_V[t] = V
+        self._is_V_predicted[t] = True
+
+    def _roll(self, t, last_update, iters, volume, in_session):
+        """
+        The rollovers of push_tick_1 of the tickers t from last_update to iters, step by step across tickers
+
+        A p_vol that is not finite leaves the interval's p_vol as it was, with a warning.
+        push_tick_1 does so on an overflow only and raises on NaN, which here would stop
+        the batch of every ticker halfway.
+        """
+
+        n = self._n_interval
+        gaps = iters - last_update
+        if np.any(gaps > 1):
+            warnings.warn('Over %d secs without receiving data' % self._interval)
+
+        # the volume is spread over the intervals up to iters along the pattern, as push_tick_1 does
+        den = np.zeros(len(t))
+        for j in range(gaps.max()):
+            m = gaps > j
+            den[m] += self._intraday_percentage[t[m], last_update[m] + 1 + j]
+        for j in range(gaps.max()):
+            m = gaps > j
+            tm, k = t[m], last_update[m] + 1 + j
+            vol = self._today_vol[tm, k] + volume[m] * self._intraday_percentage[tm, k] / den[m]
+            self._today_vol[tm, k] = np.where(in_session[m], py2_round(vol), vol)
+
+        p_per_sum = np.zeros(len(t))
+        for j in range(gaps.max()):
+            m = gaps > j
+            tm, i = t[m], last_update[m] + j
+            mean, phi = self._AR_pars[tm, 0], self._AR_pars[tm, 1]
+            ip = self._intraday_percentage
+            with np.errstate(all = 'ignore'):
+                p_vol = (phi * (self._today_vol[tm, i] / ip[tm, i] - mean) + mean) * ip[tm, i + 1]
+            finite = np.isfinite(p_vol)
+            if not finite.all():
+                warnings.warn('p_vol of %s is not finite, left as it was' % ', '.join(self.tickers[k] for k in tm[~finite]))
+            self._p_vol[tm[finite], i[finite] + 1] = np.trunc(p_vol[finite])
+
+            with np.errstate(all = 'ignore'):
+                p_per_sum[m] = self._p_per_sum[tm]
+                p_per = self._p_vol[tm, i + 1] * (1 - p_per_sum[m]) / (self._predicted_V[tm] * (1 - self._ip_cumsum[tm, i + 1] / n))
+            p_per = np.where(i + 2 < n, p_per, 1 - p_per_sum[m])
+            self._p_per[tm, i + 1] = p_per
+            self._p_per_sum[tm] = p_per_sum[m] + p_per
+
+        self._last_update[t] = iters
+        tail = in_session & (iters + 1 < n) # the rest of the day is scaled lazily, see VWAP._start_sums
+        self._p_per_scale[t[tail]] = (1 - p_per_sum[tail]) / self._p_per_suffix[t[tail], iters[tail] + 1]
+
+    def get_predict(self, indices, nanos):
+        """VWAP.get_predict of the tickers at indices, at nanos (one or one per ticker)"""
+
+        indices = np.asarray(indices, dtype = int)
+        sec_time, iters = session_iters(nanos, self._t_start_nano, self._session_map)
+
+        p_per = self._p_per[indices, iters] * np.where(iters > self._last_update[indices], self._p_per_scale[indices], 1.)
+        p_per = np.where((sec_time < 0) | (sec_time >= self.T_END_SECS) | (iters < 0), 0., p_per)
+
+        return float(p_per) if p_per.ndim == 0 else p_per
+
+    def get_log(self, index):
+        """The _VWAP_log of one ticker, rebuilt from the arrays"""
+
+        if not self._active[index]:
+            return {}
+
+        last_update = self._last_update[index]
+        log = dict((self._datetime_index[i], get_log(self._today_vol[index, i], self._p_vol[index, i], self._p_per[index, i]))
+                   for i in range(last_update))
+        log[self._datetime_index[last_update]] = get_log(None, self._p_vol[index, last_update], self._p_per[index, last_update])
+
+        return log
+
+
 if __name__ == "__main__":
     
     interval = 30
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tuning of the VWAP model settings on history: the Lasso lambda, N_HIST_DAY and the interval.
+
+Every tick file under DATA_PATH is summarized once into a day dataset (n_tick, call
+auction, session total and the interval volumes at a base interval of every ticker and
+day), cached in an npz file and an npy file of the volumes, and rebuilt once DATA_PATH, its dates or the intervals no
+longer match it. Each grid point then fits the VWAP model of every ticker on
+the days before each test day, the way VWAP_handler would that morning, and scores it on
+the test day itself, replaying the day's interval volumes through the live prediction:
+
+    python vwap_tune.py ./data_path/ ./day_dataset.npz 1e5,812314,1e7 9,15,21 30,60,300 20 4
+
+for lambdas, n_hist_days, intervals, the number of test days and the pool size.
+"""
+
+import sys
+from datetime import datetime
+from datetime import time as dt_time
+from multiprocessing import Pool
+from os.path import abspath
+from os.path import isfile
+
+import numpy as np
+
+from tick_store import NANO
+from tick_store import SESSIONS
+from tick_store import interval_volume
+from tick_store import session_map
+from tick_store import tree_files
+from vwap_handler_v2_py2 import VWAP
+from vwap_handler_v2_py2 import VWAPBook
+from vwap_handler_v2_py2 import read_history_day
+
+DATASET_FIELDS = ('data_path', 'tickers', 'dates', 'base_interval', 'n_tick', 'ca', 'total', 'volume')
+
+_dataset = None # the day dataset of a pool worker, loaded once by _init_worker
+
+
+def _summarize_date(args):
+    """Pool worker: n_tick, ca, total and base interval volumes of the tickers of one date"""
+
+    data_path, store_path, date_str, tickers, base_interval = args
+    histo_date = datetime.strptime(date_str, '%Y%m%d').date()
+    n_base = int(session_map(base_interval, SESSIONS)[0][-1]) + 1
+
+    n_tick = np.zeros(len(tickers), dtype = int)
+    ca = np.zeros(len(tickers))
+    total = np.zeros(len(tickers))
+    volume = np.zeros((len(tickers), n_base))
+    for i, ticker in enumerate(tickers):
+        if ticker is None: # no file that day
+            continue
+        day = read_history_day(ticker, histo_date, data_path, store_path)
+        if day is None:
+            continue
+        n_tick[i] = day['n_tick']
+        ca[i] = day['ca']
+        total[i] = day['total']
+        volume[i] = interval_volume(day['volume'], base_interval)
+
+    return n_tick, ca, total, volume
+
+
+def build_day_dataset(data_path, cache_path, store_path = None, base_interval = 30, n_workers = 1):
+    """
+    Summarize every tick file under data_path into the day dataset at cache_path
+
+    Tickers missing on a day have n_tick 0. Tuned intervals must be multiples of
+    base_interval, which must divide every trading session of SESSIONS.
+
+    Returns:
+        the dataset, a dict of DATASET_FIELDS with tickers x dates (x intervals) arrays
+    """
+
+    if any((end - start) % base_interval for start, end in SESSIONS) or base_interval % 5 != 0:
+        raise ValueError('base_interval must be a multiple of 5 secs and divide every trading session')
+
+    files = list(tree_files(data_path))
+    dates = sorted(set(date_str for date_str, _ in files))
+    tickers = sorted(set(ticker for _, ticker in files))
+    found = set(files)
+    jobs = [(data_path, store_path, date_str, [t if (date_str, t) in found else None for t in tickers], base_interval)
+            for date_str in dates]
+
+    if n_workers > 1:
+        pool = Pool(n_workers)
+        try:
+            days = pool.map(_summarize_date, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        days = [_summarize_date(job) for job in jobs]
+
+    dataset = {
+        'data_path': np.array(abspath(data_path)),
+        'tickers': np.array(tickers),
+        'dates': np.array(dates),
+        'base_interval': np.array(base_interval),
+        'n_tick': np.array([day[0] for day in days]).T.reshape(len(tickers), len(dates)),
+        'ca': np.array([day[1] for day in days]).T.reshape(len(tickers), len(dates)),
+        'total': np.array([day[2] for day in days]).T.reshape(len(tickers), len(dates)),
+        'volume': np.array([day[3] for day in days]).transpose(1, 0, 2).reshape(len(tickers), len(dates), -1)
+    }
+    with open(volume_path(cache_path), 'wb') as f:
+        np.save(f, dataset['volume'])
+    with open(cache_path, 'wb') as f:
+        np.savez(f, **dict((name, dataset[name]) for name in DATASET_FIELDS if name != 'volume'))
+
+    return dataset
+
+
+def volume_path(cache_path):
+    """The npy file of the interval volumes of the day dataset at cache_path"""
+
+    return cache_path + '.volume.npy'
+
+
+def load_day_dataset(cache_path):
+    """
+    The day dataset saved by build_day_dataset, None if there is none or it lacks a field of DATASET_FIELDS
+
+    The volumes, by far its largest array, are memory-mapped read-only, so that the
+    pool workers of tune share the pages instead of holding a copy each.
+    """
+
+    if not isfile(cache_path) or not isfile(volume_path(cache_path)):
+        return None
+
+    with np.load(cache_path) as dat:
+        if any(name not in dat.files for name in DATASET_FIELDS if name != 'volume'):
+            return None
+        dataset = dict((name, dat[name]) for name in DATASET_FIELDS if name != 'volume')
+    dataset['volume'] = np.load(volume_path(cache_path), mmap_mode = 'r')
+
+    return dataset
+
+
+def check_intervals(dataset, intervals):
+    """Raise ValueError unless every interval is a multiple of the dataset's base_interval"""
+
+    base_interval = int(dataset['base_interval'])
+    bad = [interval for interval in intervals if interval % base_interval]
+    if bad:
+        raise ValueError('intervals %s are not multiples of the base_interval %d of the day dataset, rebuild it with a '
+                         'base_interval dividing them' % (bad, base_interval))
+
+
+def stale_reason(dataset, data_path, intervals):
+    """
+    Why a day dataset can not tune intervals on the tick files under data_path
+
+    Returns:
+        None if it was built from data_path, on the dates found there now, at a
+        base_interval dividing every interval; otherwise the reason, to rebuild it
+    """
+
+    if str(dataset['data_path']) != abspath(data_path):
+        return 'built from %s' % dataset['data_path']
+    if list(dataset['dates']) != sorted(set(date_str for date_str, _ in tree_files(data_path))):
+        return 'built on other dates than those under %s' % data_path
+    try:
+        check_intervals(dataset, intervals)
+    except ValueError as e:
+        return str(e)
+
+    return None
+
+
+def history_days(n_tick, ca, before, n4regress, n4rolling, n_tick_threshold):
+    """
+    The history day indices of one ticker before a test day, as load_histories picks them
+
+    Returns:
+        (regress, rolling) day indices, oldest first, or None if there are not enough days
+    """
+
+    usable = np.flatnonzero((n_tick[:before] >= n_tick_threshold) & (n_tick[:before] > 0))
+    regress = usable[ca[usable] >= 1][-n4regress:]
+    if len(regress) < n4regress:
+        return None
+    rolling = usable[usable < regress[0]][-n4rolling:]
+    if len(rolling) < n4rolling:
+        return None
+
+    return regress, rolling
+
+
+def evaluate(dataset, lasso_lambda, n_hist_day, interval, test_days, n_tick_threshold = 1000):
+    """
+    Out-of-sample errors of one setting over the test day indices of the dataset
+
+    On each test day a VWAP is fitted from the history of every ticker with a call
+    auction and enough history, as VWAP_handler builds it that morning. The day is then
+    replayed through a VWAPBook of them: the call auction volume in one tick before the
+    opening, then the volume of each interval in one tick at its start, so that the
+    p_per each interval is given when it starts comes from the AR(1) update on the
+    intervals before and the Lasso's predicted daily volume, as live.
+
+    Returns:
+        a dict of the setting and
+            n: the number of ticker days scored
+            volume_error: mean |predicted / traded daily volume - 1|
+            volume_error_median: its median
+            percentage_error: mean over ticker days of sum |predicted - traded share|
+                of each interval, 0 for a perfect profile and 2 at worst
+    """
+
+    n_base = interval // int(dataset['base_interval'])
+    if n_base < 1 or interval % int(dataset['base_interval']) != 0:
+        raise ValueError('interval %d is not a multiple of the dataset base interval' % interval)
+    if any((end - start) % interval for start, end in SESSIONS): # its buckets would span a break
+        raise ValueError('interval %d does not divide every trading session' % interval)
+    n4rolling = int(n_hist_day / 3)
+    n4regress = n_hist_day - n4rolling
+    n_ticker = len(dataset['tickers'])
+    n_tick = dataset['n_tick']
+    ca = dataset['ca']
+
+    starts = np.concatenate([np.arange(start, end, interval) for start, end in SESSIONS]) # each interval's first sec
+
+    def interval_volumes(i, days):
+        return dataset['volume'][i, days].reshape(len(days), -1, n_base).sum(axis = 2)
+
+    volume_errors = []
+    percentage_errors = []
+    for d in test_days:
+        samples = []
+        for i in range(n_ticker):
+            if n_tick[i, d] < max(n_tick_threshold, 1) or ca[i, d] < 1:
+                continue
+            days = history_days(n_tick[i], ca[i], d, n4regress, n4rolling, n_tick_threshold)
+            if days is not None:
+                samples.append((i, days[0], days[1]))
+        if not samples:
+            continue
+
+        kwargs = {'TODAY': datetime.strptime(str(dataset['dates'][d]), '%Y%m%d').date(), 'T_START_TIME': dt_time(9, 30),
+                  'T_END_TIME': dt_time(15, 0), 'LASSO_LAMBDA': lasso_lambda, 'N_TICK_THRESHOLD': n_tick_threshold,
+                  'DATA_PATH': None, 'N_HIST_DAY': n_hist_day}
+        vwaps = {}
+        for i, regress, rolling in samples:
+            history = {'ca': ca[i, regress], 'histo_volume': interval_volumes(i, regress),
+                       'volume_sums': dataset['total'][i, rolling], 'n_day': n4regress + n4rolling}
+            vwaps[str(dataset['tickers'][i])] = VWAP(interval, str(dataset['tickers'][i]), kwargs, history)
+        book = VWAPBook(vwaps)
+        rows = np.array([book.index[str(dataset['tickers'][i])] for i, _, _ in samples])
+
+        traded = np.array([interval_volumes(i, [d])[0] for i, _, _ in samples])
+        traded_V = traded.sum(axis = 1)
+        nanos = book._t_start_nano + NANO * np.append(-1, starts)
+        cum_volumes = ca[[i for i, _, _ in samples], d][:, None] + np.hstack([np.zeros((len(samples), 1)), traded.cumsum(axis = 1)])
+        book.push_ticks(np.repeat(rows, len(nanos)), np.tile(nanos, len(samples)), cum_volumes.ravel())
+
+        predicted_V = book._predicted_V[rows]
+        p_per = book._p_per[rows]
+        volume_errors.extend(np.abs(predicted_V / traded_V - 1))
+        percentage_errors.extend(np.abs(p_per - traded / traded_V[:, None]).sum(axis = 1))
+
+    return {
+        'lasso_lambda': lasso_lambda,
+        'n_hist_day': n_hist_day,
+        'interval': interval,
+        'n': len(volume_errors),
+        'volume_error': np.mean(volume_errors) if volume_errors else np.nan,
+        'volume_error_median': np.median(volume_errors) if volume_errors else np.nan,
+        'percentage_error': np.mean(percentage_errors) if percentage_errors else np.nan
+    }
+
+
+def _init_worker(cache_path):
+
+    global _dataset
+    _dataset = load_day_dataset(cache_path)
+
+
+def _evaluate_setting(args):
+    """Pool worker: evaluate one setting on the worker's dataset"""
+
+    return evaluate(_dataset, *args)
+
+
+def tune(cache_path, lasso_lambdas, n_hist_days, intervals, n_test_day = 20, n_tick_threshold = 1000, n_workers = 1):
+    """
+    Evaluate every (lasso_lambda, n_hist_day, interval) setting on the last n_test_day days
+
+    The day dataset at cache_path (see build_day_dataset) is loaded once per process,
+    its volumes memory-mapped, and shared by all the settings, which are spread across n_workers processes.
+    Intervals that are not multiples of its base_interval raise ValueError up front.
+
+    Returns:
+        the evaluate dicts of the settings, best volume_error first
+    """
+
+    dataset = load_day_dataset(cache_path)
+    if dataset is None:
+        raise IOError('no day dataset at %s, see build_day_dataset' % cache_path)
+    check_intervals(dataset, intervals)
+    test_days = list(range(len(dataset['dates'])))[-n_test_day:]
+    settings = [(float(l), int(n), int(i), test_days, n_tick_threshold)
+                for l in lasso_lambdas for n in n_hist_days for i in intervals]
+
+    if n_workers > 1:
+        pool = Pool(n_workers, _init_worker, (cache_path,))
+        try:
+            results = pool.map(_evaluate_setting, settings)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [evaluate(dataset, *setting) for setting in settings]
+
+    return sorted(results, key = lambda r: (np.isnan(r['volume_error']), r['volume_error']))
+
+
+if __name__ == "__main__":
+
+    data_path, cache_path = sys.argv[1:3]
+    lasso_lambdas = [float(l) for l in sys.argv[3].split(',')]
+    n_hist_days = [int(n) for n in sys.argv[4].split(',')]
+    intervals = [int(i) for i in sys.argv[5].split(',')]
+    n_test_day = int(sys.argv[6]) if len(sys.argv) > 6 else 20
+    n_workers = int(sys.argv[7]) if len(sys.argv) > 7 else 1
+
+    dataset = load_day_dataset(cache_path)
+    reason = None if dataset is None else stale_reason(dataset, data_path, intervals)
+    if reason is not None:
+        print('Rebuilding the day dataset at %s, %s' % (cache_path, reason))
+    if dataset is None or reason is not None:
+        build_day_dataset(data_path, cache_path, base_interval = int(np.gcd.reduce(intervals)), n_workers = n_workers)
+
+    print('%12s %10s %8s %6s %12s %12s %12s' % ('lasso_lambda', 'n_hist_day', 'interval', 'n', 'volume_err', 'median', 'pct_err'))
+    for r in tune(cache_path, lasso_lambdas, n_hist_days, intervals, n_test_day, n_workers = n_workers):
+        print('%12g %10d %8d %6d %12.4f %12.4f %12.4f' % (r['lasso_lambda'], r['n_hist_day'], r['interval'], r['n'],
+                                                          r['volume_error'], r['volume_error_median'], r['percentage_error']))